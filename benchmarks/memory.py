@@ -0,0 +1,52 @@
+"""
+Memory used by a loaded story
+
+Loads a generated story and measures the memory allocated for the
+compiled story, and the size of its compiled cache entry, per thousand
+lines of script.
+
+    python benchmarks/memory.py [-k KNOTS]
+"""
+
+import os
+import sys
+import pickle
+import argparse
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lils.ink import Story  # noqa: E402
+from parse import generate  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("-k", "--knots", type=int, default=2000)
+    args = parser.parse_args()
+
+    source = generate(args.knots)
+    lines = source.count("\n") + 1
+
+    with tempfile.NamedTemporaryFile("w", suffix=".ink") as f:
+        f.write(source)
+        f.flush()
+        # the parser is built before measuring
+        Story(f.name, use_cache=False)
+
+        tracemalloc.start()
+        before, _peak = tracemalloc.get_traced_memory()
+        story = Story(f.name, use_cache=False)
+        after, _peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    size = len(pickle.dumps(story.script))
+    print(f"story: {lines} lines, {args.knots} knots")
+    per_line = 1000 / lines / 1024
+    print(f"memory: {(after - before) * per_line:7.1f} KiB per 1000 lines")
+    print(f" cache: {size * per_line:7.1f} KiB per 1000 lines")
+
+
+if __name__ == "__main__":
+    main()
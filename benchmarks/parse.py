@@ -0,0 +1,103 @@
+"""
+Parse time and peak memory for a large generated story
+
+Compares building the full parse tree and transforming it afterwards with
+the parser that applies the transformer while parsing, and the time to the
+first output of a session with the whole story loaded and with lazy knots.
+
+    python benchmarks/parse.py [-k KNOTS]
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import tracemalloc
+
+from lark import Lark
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import lils  # noqa: E402
+from lils.ink import Session, Story  # noqa: E402
+from lils.parser import InkTransformer, get_parser  # noqa: E402
+
+
+KNOT = """
+=== knot_{i} ===
+This is the knot number {i}, with some text to read. # tag {i}
+And a second line <>
+glued to the next one.
+~ count = count + 1
+* {{count > 0}} First option # wait: 500
+  The first option content
+  -> knot_{next}
+* Second [option] choice
+  -> knot_{next}.stitch
+* Third option
+  -> END
+
+= stitch
+Stitch content for the knot {i}.
+-> knot_{next}
+"""
+
+
+def generate(knots):
+    story = ["VAR count = 0", "Start of the story", "-> knot_0"]
+    story += [KNOT.format(i=i, next=(i + 1) % knots) for i in range(knots)]
+    return "\n".join(story)
+
+
+def tree_parse(parser, source):
+    return InkTransformer().transform(parser.parse(source))
+
+
+def inline_parse(parser, source):
+    return parser.parse(source)
+
+
+def measure(name, fn, parser, source):
+    start = time.perf_counter()
+    fn(parser, source)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    fn(parser, source)
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"{name:>7}: {elapsed:6.2f} s, peak memory {peak / 2**20:7.1f} MiB")
+
+
+def first_output(path, lazy):
+    start = time.perf_counter()
+    session = Session(Story(path, use_cache=False, lazy=lazy))
+    session.run()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("-k", "--knots", type=int, default=8000)
+    args = parser.parse_args()
+
+    source = generate(args.knots)
+    print(f"story: {len(source) / 2**20:.1f} MiB, {args.knots} knots")
+
+    grammar = os.path.join(os.path.dirname(lils.__file__), "ink.lark")
+    tree_parser = Lark.open(grammar, parser="lalr")
+    measure("tree", tree_parse, tree_parser, source)
+    measure("inline", inline_parse, get_parser(), source)
+
+    with tempfile.NamedTemporaryFile("w", suffix=".ink") as f:
+        f.write(source)
+        f.flush()
+        for name, lazy in [("eager", False), ("lazy", True)]:
+            elapsed = first_output(f.name, lazy)
+            print(f"{name:>7}: {elapsed:6.2f} s to the first output")
+
+
+if __name__ == "__main__":
+    main()
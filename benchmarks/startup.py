@@ -0,0 +1,58 @@
+"""
+Time to the first line of the lils CLI
+
+Runs `python -m lils script.ink` several times and measures the time until
+the first line of the script is printed, with an empty cache (cold) and
+with the parser tables and the compiled script in the cache (warm).
+
+    python benchmarks/startup.py [script.ink] [-n RUNS]
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def first_line(path, cache_dir):
+    env = dict(os.environ, LILS_CACHE_DIR=cache_dir, PYTHONPATH=ROOT)
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "-m", "lils", path], env=env,
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    process.stdout.readline()
+    elapsed = time.perf_counter() - start
+    process.kill()
+    process.wait()
+    return elapsed
+
+
+def report(name, times):
+    print(f"{name:>5}: median {statistics.median(times) * 1000:7.1f} ms, "
+          f"min {min(times) * 1000:7.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("script", nargs="?",
+                        default=os.path.join(ROOT, "examples", "basic.ink"))
+    parser.add_argument("-n", "--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    cold, warm = [], []
+    for _ in range(args.runs):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cold.append(first_line(args.script, cache_dir))
+            warm.append(first_line(args.script, cache_dir))
+
+    report("cold", cold)
+    report("warm", warm)
+
+
+if __name__ == "__main__":
+    main()
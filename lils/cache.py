@@ -0,0 +1,89 @@
+import os
+import pickle
+import hashlib
+
+
+def cache_dir():
+    """
+    Directory used to store lils cached files, None if the cache is disabled
+
+    It can be configured with the LILS_CACHE_DIR environment variable, and
+    disabled setting LILS_NO_CACHE=1.
+    """
+
+    if os.environ.get("LILS_NO_CACHE"):
+        return None
+
+    path = os.environ.get("LILS_CACHE_DIR")
+    if not path:
+        xdg = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+        path = os.path.join(xdg, "lils")
+
+    try:
+        os.makedirs(path, exist_ok=True)
+    except OSError:
+        return None
+
+    return path
+
+
+def cache_path(name):
+    """
+    Full path for the name file inside the cache directory or None if the
+    cache is disabled
+    """
+
+    path = cache_dir()
+    if not path:
+        return None
+    return os.path.join(path, name)
+
+
+def file_digest(path):
+    """
+    sha256 hex digest of the file content, None if the file can't be read
+    """
+
+    try:
+        with open(path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+
+
+def load(name):
+    """
+    Unpickle the cached object stored with this name, None if there's no
+    valid cached object
+    """
+
+    path = cache_path(name)
+    if not path:
+        return None
+
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except Exception:
+        return None
+
+
+def store(name, obj):
+    """
+    Pickle the object in the cache with this name. The file is replaced
+    atomically so concurrent readers never see a partial file
+    """
+
+    path = cache_path(name)
+    if not path:
+        return
+
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp, "wb") as f:
+            pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    except Exception:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
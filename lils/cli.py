@@ -1,51 +1,86 @@
 import argparse
 
-from lils.ink import InkScript
+from lils.ink import InkScript, InkError, Options, Text
 
 
-def show_output(script):
+def show_line(script, line):
     # TODO: Add ritch text formatting (maybe md)
+    if line.reply:
+        print(f"- {line}")
+    else:
+        line.run_command(script)
+        print(line)
+
+
+def show(script, stream):
+    """
+    Print the output lines as they are produced, returns the options
+    """
+
+    for item in stream:
+        match item:
+            case Text():
+                show_line(script, item)
+            case options:
+                return options
+    # a listener moved the script to other question while streaming
+    return show_current(script)
+
+
+def show_current(script):
+    """
+    Print the current output, returns the current options
+    """
+
+    question = script._question
     for line in script.output:
-        if line.reply:
-            print(f"- {line}")
-        else:
-            line.run_command()
-            print(line)
+        show_line(script, line)
+    return Options(script.options, question)
+
 
+def show_options(script, options):
+    """
+    Print the options and read the selected one, returns its index or None
+    if the script is finished. A listener can choose an option while waiting
+    for the input, then the new output and options are shown and read again.
+    """
 
-def show_options(script):
-    for i, option in enumerate(script.options):
+    for i, option in enumerate(options):
         # TODO: Add ritch text formatting (maybe md)
         print(f"{i+1}. {option.option}")
 
-    # TODO: Add listeners logic
     selected = input("> ")
+    if script._question != options.question:
+        options = show_current(script)
+        if not options:
+            return None
+        return show_options(script, options)
+
     try:
-        selected = int(selected)
+        index = int(selected) - 1
     except ValueError:
-        print(f"No valid option '{selected}'. Please write a correct option number")
-        show_options(script)
-        return
+        index = -1
 
-    if selected > len(script.options) or selected < 1:
+    if not 0 <= index < len(options):
         print(f"No valid option '{selected}'. Please write a correct option number")
-        show_options(script)
-        return
+        return show_options(script, options)
 
-    script.choose(selected - 1)
+    return index
 
 
 def run(path):
     script = InkScript(path)
-    script.run()
-
-    while not script.finished:
-        if script.output:
-            show_output(script)
-        if script.options:
-            show_options(script)
+    options = show(script, script.stream())
 
-    show_output(script)
+    while options:
+        selected = show_options(script, options)
+        if selected is None:
+            break
+        try:
+            options = show(script, script.stream(selected))
+        except InkError:
+            # a listener chose an option just before
+            options = show_current(script)
 
 
 def main():
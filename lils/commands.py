@@ -1,44 +1,123 @@
-import re
-import webbrowser
+import threading
 import subprocess
 
+from concurrent.futures import ThreadPoolExecutor
 
-COMMANDRE = re.compile(r"^(?P<command>[^:]+):\s*(?P<args>([^\s]+\s*)+)$")
+from .registry import COMMANDS, UnknownTag, compile_tag
 
 
-# Commands
+MAX_WORKERS = 4
+# Exit status for commands that don't finish before the timeout or can't be
+# started
+STATUS_TIMEOUT = -1
+STATUS_NOT_FOUND = 127
+
+_EXECUTOR = None
+_EXECUTOR_LOCK = threading.Lock()
+
+
+def _get_executor():
+    global _EXECUTOR
+
+    with _EXECUTOR_LOCK:
+        if _EXECUTOR is None:
+            _EXECUTOR = ThreadPoolExecutor(max_workers=MAX_WORKERS,
+                                           thread_name_prefix="lils-command")
+        return _EXECUTOR
+
+
+# Commands, they return the process arguments to run or None
 
 def command_test(args):
     return ["test"] + args.split(" ")
 
 
 def command_url(args):
+    import webbrowser
+
     webbrowser.open_new(args)
 
 
 def command_xdgopen(args):
-    subprocess.run(["xdg-open", args])
+    return ["xdg-open", args]
 
 
 def command_terminal(args):
-    subprocess.run(["xdg-terminal"])
+    return ["xdg-terminal"]
 
 
 def command_launch(args):
-    subprocess.run(["gtk-launch", f"{args}.desktop"])
+    return ["gtk-launch", f"{args}.desktop"]
+
+
+def _execute(command):
+    """
+    Run the command handler and the process it returns, returns the
+    (exit status, output). The process is only waited for if the command
+    has a timeout, status or output, otherwise the exit status is None.
+    """
+
+    handler = COMMANDS.get(command.name)
+    argv = handler(command.args) if handler else None
+    if not isinstance(argv, list):
+        return 0, ""
+
+    if not command.options:
+        # Launched applications like a terminal can run for a long time,
+        # they can't keep a worker busy
+        try:
+            subprocess.Popen(argv, stdin=subprocess.DEVNULL)
+        except OSError:
+            return STATUS_NOT_FOUND, ""
+        return None, ""
+
+    # The output is only captured if it's needed, because launched
+    # applications can keep the pipe open
+    capture = "output" in command.options
+    try:
+        process = subprocess.run(argv, stdin=subprocess.DEVNULL,
+                                 stdout=subprocess.PIPE if capture else None,
+                                 timeout=command.options.get("timeout"))
+    except subprocess.TimeoutExpired:
+        return STATUS_TIMEOUT, ""
+    except OSError:
+        return STATUS_NOT_FOUND, ""
+
+    output = process.stdout.decode(errors="replace").strip() if capture else ""
+    return process.returncode, output
+
+
+def _store_result(future, command, session):
+    if future.cancelled() or future.exception():
+        return
 
+    status, output = future.result()
+    values = {}
+    if "status" in command.options:
+        values[command.options["status"]] = status
+    if "output" in command.options:
+        values[command.options["output"]] = output
+    session.set_many(values)
 
-def run_command(command_line):
-    if not command_line:
-        return
 
-    match = COMMANDRE.match(command_line)
-    if not match:
-        return
+def submit(command, session=None):
+    """
+    Run the command in the commands thread pool, returns a future with the
+    (exit status, output). The results are stored in the session variables
+    named by the status and output options when the command is done.
+    """
 
-    command = match.group("command")
-    args = match.group("args")
+    future = _get_executor().submit(_execute, command)
+    if session is not None and command.options.keys() & {"status", "output"}:
+        future.add_done_callback(lambda f: _store_result(f, command, session))
+    return future
+
+
+def run_command(command_line):
+    try:
+        command, _listener = compile_tag(command_line)
+    except UnknownTag:
+        return None
 
-    command = f"command_{command}"
-    if command in globals():
-        globals()[command](args)
+    if command:
+        return submit(command)
@@ -12,8 +12,9 @@ gi.require_version("GLib", "2.0") # noqa
 from gi.repository import Gio # noqa
 from gi.repository import GLib # noqa
 
-from .ink import InkScript
+from .ink import InkScript, InkError
 from .ink import Text, Option
+from .sessions import SessionTable, UnknownSession
 
 
 APPID = "net.danigm.lils"
@@ -28,28 +29,43 @@ class LilsService(Gio.Application):
       <interface name='{APPID}'>
         <method name='launch'>
           <arg type='s' name='filename' direction='in'/>
+          <arg type='s' name='session' direction='out'/>
           <arg type='as' name='output' direction='out'/>
         </method>
         <method name='choose'>
+          <arg type='s' name='session' direction='in'/>
           <arg type='u' name='option' direction='in'/>
           <arg type='as' name='output' direction='out'/>
         </method>
         <method name='output'>
+          <arg type='s' name='session' direction='in'/>
           <arg type='as' name='output' direction='out'/>
         </method>
         <method name='options'>
+          <arg type='s' name='session' direction='in'/>
           <arg type='as' name='output' direction='out'/>
         </method>
         <method name='var'>
+          <arg type='s' name='session' direction='in'/>
           <arg type='s' name='name' direction='in'/>
           <arg type='v' name='value' direction='out'/>
         </method>
+        <method name='set'>
+          <arg type='s' name='session' direction='in'/>
+          <arg type='a{{sv}}' name='values' direction='in'/>
+        </method>
         <method name='finished'>
+          <arg type='s' name='session' direction='in'/>
           <arg type='b' name='output' direction='out'/>
         </method>
+        <method name='close'>
+          <arg type='s' name='session' direction='in'/>
+        </method>
 
         <method name='reset'></method>
-        <signal name='changed'></signal>
+        <signal name='changed'>
+          <arg type='s' name='session'/>
+        </signal>
         <signal name='reset'></signal>
       </interface>
     </node>
@@ -57,12 +73,21 @@ class LilsService(Gio.Application):
 
     # Five minutes without changes
     _INACTIVITY_TIMEOUT = 5 * 60 * 1000
+    _MAX_SESSIONS = 64
+    # Sessions not used in 30 minutes are closed
+    _SESSION_TIMEOUT = 30 * 60
+    # Changes in the same 100ms emit only one changed signal
+    _CHANGED_DEBOUNCE = 0.1
 
     def __init__(self):
         super().__init__(application_id=self._DBUS_NAME,
                          inactivity_timeout=self._INACTIVITY_TIMEOUT)
         self._dbus_id = None
         self._state = None
+        self._expire_id = None
+        self._sessions = SessionTable(max_sessions=self._MAX_SESSIONS,
+                                      idle_timeout=self._SESSION_TIMEOUT,
+                                      factory=self._new_session)
 
     def _on_method_called(self, connection, sender, path, iface,
                           method, params, invocation):
@@ -70,52 +95,81 @@ class LilsService(Gio.Application):
         # the inactivity timeout for each method call.
         self.hold()
 
-        ret = getattr(self, method)(params)
-        if ret is not None:
-            ret = self.convert_variant_arg(ret)
+        try:
+            ret = getattr(self, method)(params)
+        except UnknownSession as e:
+            invocation.return_dbus_error(f"{self._DBUS_IFACE}.UnknownSession",
+                                         f"Unknown session {e}")
+        except InkError as e:
+            invocation.return_dbus_error(f"{self._DBUS_IFACE}.InkError", str(e))
+        else:
+            if ret is not None:
+                ret = self.convert_variant_arg(ret)
             invocation.return_value(ret)
-
-        # Ensure release() is always called.
-        self.release()
+        finally:
+            # Ensure release() is always called.
+            self.release()
 
     def reset(self, params):
         self.emit("reset")
-        self.emit("changed")
+        for session_id in self._sessions:
+            self.emit("changed", GLib.Variant('(s)', (session_id, )))
 
     def launch(self, params):
         filename = params[0]
-        self._script = InkScript(filename, on_change=self._on_change)
-        self._script.run()
-        return self._script.output
+        session_id, script = self._sessions.create(filename)
+        script.run()
+        output = [str(i) for i in script.output]
+        return GLib.Variant('(sas)', (session_id, output))
 
     def choose(self, params):
-        option = params[0]
-        self._script.choose(option)
-        return self._script.output
+        session_id, option = params
+        script = self._sessions.get(session_id)
+        script.choose(option)
+        return script.output
 
     def output(self, params):
-        return self._script.output
+        return self._sessions.get(params[0]).output
 
     def options(self, params):
-        return self._script.options
+        return self._sessions.get(params[0]).options
 
     def finished(self, params):
-        return self._script.finished
+        return self._sessions.get(params[0]).finished
+
+    def close(self, params):
+        self._sessions.remove(params[0])
 
     def var(self, params):
-        key = params[0]
-        value = self._script.var(key)
+        session_id, key = params
+        value = self._sessions.get(session_id).var(key)
         if value is None:
             value = ""
         return GLib.Variant('(v)', (self.convert_variant_arg(value), ))
 
-    def _on_change(self, *args):
-        self.emit("changed")
+    def set(self, params):
+        session_id, values = params
+        self._sessions.get(session_id).set_many(values)
 
-    def emit(self, signal):
+    def _new_session(self, session_id, path):
+        # The listeners and commands threads changes are run in the main loop
+        return InkScript(path,
+                         on_change=lambda *args: self._on_change(session_id),
+                         dispatch=GLib.idle_add,
+                         debounce=self._CHANGED_DEBOUNCE)
+
+    def _on_change(self, session_id):
+        if session_id in self._sessions:
+            self.emit("changed", GLib.Variant('(s)', (session_id, )))
+
+    def _expire_sessions(self):
+        self._sessions.expire()
+        return GLib.SOURCE_CONTINUE
+
+    def emit(self, signal, params=None):
         self.get_dbus_connection().emit_signal(None, self._DBUS_PATH,
                                                self._DBUS_IFACE,
-                                               signal, None)
+                                               signal, params)
 
     def do_dbus_register(self, connection, path):
         info = Gio.DBusNodeInfo.new_for_xml(self._DBUS_XML)
@@ -132,7 +186,7 @@ class LilsService(Gio.Application):
         self._dbus_id = None
 
     def do_startup(self):
-        self._script = None
+        self._expire_id = GLib.timeout_add_seconds(60, self._expire_sessions)
 
         # Call hold/release here, so the inactivity-timeout is used correctly
         # (as the overridden value is only used after a release call).
@@ -142,14 +196,15 @@ class LilsService(Gio.Application):
         Gio.Application.do_startup(self)
 
     def do_activate(self):
-        self._script = None
-
         self.hold()
         self.release()
 
         Gio.Application.do_activate(self)
 
     def do_shutdown(self):
+        if self._expire_id:
+            GLib.source_remove(self._expire_id)
+            self._expire_id = None
         Gio.Application.do_shutdown(self)
 
     def do_command_line(self, command_line):
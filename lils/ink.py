@@ -1,39 +1,143 @@
 import os
+import re
+import json
+import hashlib
+import threading
+import weakref
+import warnings
+
+from contextlib import contextmanager
+
+from array import array
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field, replace
+from typing import Optional, Any
 
-from lark import Lark
-from lark import Token
-from lark import Transformer
-from lark.visitors import Discard
+from . import cache
+from .commands import submit
+from .listeners import run_listeners, cancel_listeners
+from .registry import compile_tag, UnknownTag
 
-from dataclasses import dataclass
-from typing import Optional, Any
 
-from .commands import run_command
-from .listeners import run_listeners
+class InkError(Exception):
+    pass
 
-from operator import add, sub, mul, truediv as div, neg
-from operator import eq, lt, gt, le, ge, not_, and_, or_, truth
 
+class InkWarning(UserWarning):
+    pass
 
-class Evaluable:
+
+class IncludeError(InkError):
     pass
 
 
+# Shared dependency sets, most expressions read the same few variables
+_DEPS = {}
+
+
+def _intern_deps(names):
+    return _DEPS.setdefault(names, names)
+
+
+def _constant(value):
+    return lambda vars, visits: value
+
+
+def compile_expression(item, addresses):
+    """
+    Returns a function that evaluates the item for the variables and visit
+    counts, the item can be an Evaluable or a literal value
+    """
+
+    if isinstance(item, Evaluable):
+        return item.compile(addresses)
+    return _constant(item)
+
+
+class Evaluable:
+    # Compiled function and the names it reads, created the first time
+    # they're needed and not stored in the compiled story cache
+    __slots__ = ("_fn", "_deps")
+
+    def compile(self, addresses):
+        """
+        Returns a function that evaluates this expression for the variables
+        dict and the visit counts array. The addresses dict maps knot and
+        stitch names to the index in the visit counts array.
+        """
+
+        raise NotImplementedError
+
+    def dependencies(self):
+        """
+        Returns the names of the variables, knots and stitches read by this
+        expression
+        """
+
+        return frozenset()
+
+    def link(self, addresses):
+        self._fn = self.compile(addresses)
+        self._deps = _intern_deps(self.dependencies())
+        return self._fn
+
+    def is_constant(self):
+        return False
+
+    @property
+    def deps(self):
+        try:
+            return self._deps
+        except AttributeError:
+            self._deps = _intern_deps(self.dependencies())
+            return self._deps
+
+    @property
+    def compiled(self):
+        try:
+            return self._fn
+        except AttributeError:
+            self._fn = self.compile({})
+            return self._fn
+
+    def evaluate(self, vars, visits=()):
+        return self.compiled(vars, visits)
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__dataclass_fields__}
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+
 class Tagged:
-    def run_command(self):
-        run_command(self.tag)
+    __slots__ = ()
+
+    def run_command(self, session=None):
+        """
+        Run the tag command in the background, returns a future with the
+        (exit status, output) or None if there's no command
+        """
+
+        if self.command:
+            return submit(self.command, session)
 
     def run_listeners(self, script, index, question):
-        run_listeners(self.tag, script, index, question)
+        run_listeners(self.listener, script, index, question)
 
 
-@dataclass
+@dataclass(slots=True)
 class Text(Tagged):
     text: str
     tag: Optional[str] = None
     glue_start: bool = False
     glue_end: bool = False
     reply: bool = False
+    # The tag command and listener, compiled when the script is loaded
+    command: Optional[Any] = field(default=None, compare=False, repr=False)
+    listener: Optional[Any] = field(default=None, compare=False, repr=False)
 
     def __str__(self):
         return self.text
@@ -45,11 +149,15 @@ class Text(Tagged):
         return str(self) == str(other)
 
 
-@dataclass
+@dataclass(slots=True)
 class Divert:
     to: str
     stitch: Optional[str] = None
     inline: bool = False
+    # Resolved when the script is loaded, the target index in the address
+    # table and the visit counters to increment
+    address: Optional[int] = field(default=None, compare=False, repr=False)
+    visits: tuple = field(default=(), compare=False, repr=False)
 
     def __str__(self):
         to = f"-> {self.to}"
@@ -58,7 +166,7 @@ class Divert:
         return to
 
 
-@dataclass
+@dataclass(slots=True)
 class Texts:
     content: [Text]
     divert: Optional[Divert]
@@ -75,24 +183,37 @@ class Texts:
         return self.content == other.content and self.divert == content.divert
 
 
-@dataclass
+@dataclass(slots=True)
 class Condition(Evaluable):
     operator: Any
     item1: Any
     item2: Any
 
-    def evaluate(self, context):
-        i1 = self.item1
-        if isinstance(i1, Evaluable):
-            i1 = i1.evaluate(context)
-        i2 = self.item2
-        if isinstance(i2, Evaluable):
-            i2 = i2.evaluate(context)
-        ops = filter(lambda i: i is not None, (i1, i2))
-        return self.operator(*ops)
+    def is_constant(self):
+        return not any(isinstance(i, Evaluable) and not i.is_constant()
+                       for i in (self.item1, self.item2))
+
+    def dependencies(self):
+        return frozenset().union(*(i.deps for i in (self.item1, self.item2)
+                                   if isinstance(i, Evaluable)))
 
+    def compile(self, addresses):
+        operator = self.operator
+        f1 = compile_expression(self.item1, addresses)
 
-@dataclass
+        if self.item2 is None:
+            # unary operator
+            fn = lambda vars, visits: operator(f1(vars, visits))
+        else:
+            f2 = compile_expression(self.item2, addresses)
+            fn = lambda vars, visits: operator(f1(vars, visits), f2(vars, visits))
+
+        if self.is_constant():
+            return _constant(fn(None, None))
+        return fn
+
+
+@dataclass(slots=True)
 class Option(Tagged):
     text: Text
     option: str
@@ -108,13 +229,25 @@ class Option(Tagged):
     def tag(self):
         return self.text.tag
 
-    def is_available(self, context):
+    @property
+    def command(self):
+        return self.text.command
+
+    @property
+    def listener(self):
+        return self.text.listener
+
+    @property
+    def deps(self):
+        return self.logic.deps if self.logic else frozenset()
+
+    def is_available(self, vars, visits=()):
         if not self.logic:
             return True
-        return self.logic.evaluate(context)
+        return self.logic.compiled(vars, visits)
 
 
-@dataclass
+@dataclass(slots=True)
 class Stitch:
     name: str
     content: list
@@ -129,7 +262,7 @@ class Stitch:
         return len(self.content)
 
 
-@dataclass
+@dataclass(slots=True)
 class Knot:
     name: str
     content: list
@@ -149,337 +282,564 @@ class Knot:
         return cls(name=name, content=[], stitches={})
 
 
-@dataclass
+@dataclass(slots=True)
+class KnotSource:
+    """
+    Knot that is not parsed yet, with its source code and the stitch names
+    found by the index
+    """
+
+    name: str
+    source: str
+    stitches: list[str]
+
+
+@dataclass(slots=True)
 class Assignment(Evaluable):
     var: str
     value: Optional[Any] = None
     declaration: bool = False
 
-    def evaluate(self, context):
+    def is_constant(self):
         v = self.value
-        if isinstance(v, Evaluable):
-            v = v.evaluate(context)
-        return v
+        return not isinstance(v, Evaluable) or v.is_constant()
+
+    def dependencies(self):
+        if isinstance(self.value, Evaluable):
+            return self.value.deps
+        return frozenset()
 
+    def compile(self, addresses):
+        return compile_expression(self.value, addresses)
 
-@dataclass
+
+@dataclass(slots=True)
 class Var(Evaluable):
     name: str
 
-    def evaluate(self, context):
-        return context.get(self.name)
+    def dependencies(self):
+        return frozenset([self.name])
+
+    def compile(self, addresses):
+        name = self.name
+        # knot and stitch names are the visit count
+        if name in addresses:
+            index = addresses[name]
+            return lambda vars, visits: visits[index]
+        return lambda vars, visits: vars.get(name)
 
 
-@dataclass
+@dataclass(slots=True)
 class Op(Condition):
     pass
 
 
-class InkTransformer(Transformer):
-    const_none = lambda self, _: None
-    const_true = lambda self, _: True
-    const_false = lambda self, _: False
+@dataclass(slots=True)
+class Include:
+    path: str
 
-    def var(self, s):
-        (s, ) = s
-        return Var(s.value)
 
-    def add(self, s):
-        item1, _op, item2 = s
-        return Op(add, item1, item2)
+def parse(source):
+    """
+    Parse the ink source code and return the list of transformed statements
+    """
+
+    # The parser is imported on demand, so loading a compiled story from the
+    # cache doesn't import lark
+    from .parser import parse
+    return parse(source)
+
+
+def get_parser():
+    from .parser import get_parser
+    return get_parser()
+
+
+def __getattr__(name):
+    if name == "InkTransformer":
+        from .parser import InkTransformer
+        return InkTransformer
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# Knot and stitch headers, and the top level statements that can't be
+# loaded lazily because they change the whole script
+KNOTRE = re.compile(r"^[ \t]*===[ \t]*(?P<name>[a-zA-Z_]\w*)", re.M)
+STITCHRE = re.compile(r"^[ \t]*=(?!=)[ \t]*(?P<name>[a-zA-Z_]\w*)", re.M)
+TOPLEVELRE = re.compile(r"^[ \t]*(VAR|INCLUDE)\b", re.M)
+INCLUDERE = re.compile(r"^INCLUDE[ \t]*(?P<path>[^\n ]+\.ink)", re.M)
+
+
+def index_knots(source):
+    """
+    Split the source in the content before the first knot and a KnotSource
+    for each knot, without parsing it. Returns None if the source can't be
+    split, because there are variables or includes after the first knot.
+    """
+
+    headers = list(KNOTRE.finditer(source))
+    if not headers:
+        return source, []
+
+    knots = []
+    ends = [i.start() for i in headers[1:]] + [len(source)]
+    for header, end in zip(headers, ends):
+        knot = source[header.start():end]
+        if TOPLEVELRE.search(knot):
+            return None
+        stitches = [i.group("name") for i in STITCHRE.finditer(knot)]
+        knots.append(KnotSource(name=header.group("name"), source=knot,
+                                stitches=stitches))
+    return source[:headers[0].start()], knots
+
+
+def parse_script(source, lazy=False):
+    """
+    Parse the source of one file, with lazy the knots are not parsed and
+    KnotSource are returned instead
+    """
+
+    index = index_knots(source) if lazy else None
+    if index is None:
+        return parse(source)
+
+    preamble, knots = index
+    script = parse(preamble) if preamble.strip() else []
+    return script + knots
+
+
+# Bump this version when the AST classes change, so old compiled stories in
+# the cache are ignored
+COMPILED_VERSION = 4
+# Version of the Session.save_state format
+STATE_VERSION = 1
+
+
+class IncludeResolver:
+    """
+    Loads a script resolving all the INCLUDE statements
+
+    Each file is parsed only once per load, even if it's included several
+    times, and the include paths are relative to the including file. With
+    lazy, only the content before the first knot is parsed, and the knots
+    are returned as KnotSource.
+
+    With jobs > 1, all the included files are found before loading the
+    script and parsed in parallel in that number of processes. The script
+    is the same as the one loaded serially.
+    """
+
+    def __init__(self, lazy=False, jobs=1):
+        self.lazy = lazy
+        self.jobs = jobs
+        # Source files loaded with the content digest {path: digest}
+        self.files = {}
+        self._loaded = {}
+        self._stack = []
+        # Files read and parsed in parallel {path: source}, {path: script}
+        self._sources = {}
+        self._parsed = {}
+
+    def load(self, path, source=None):
+        path = os.path.abspath(path)
+        if path in self._stack:
+            cycle = " -> ".join(self._stack[self._stack.index(path):] + [path])
+            raise IncludeError(f"Include cycle: {cycle}")
+        if path in self._loaded:
+            return self._loaded[path]
+
+        if self.jobs > 1 and not self._stack:
+            self._prefetch(path, source)
+
+        if source is None:
+            source = self._sources.get(path)
+        if source is None:
+            with open(path, "rb") as f:
+                source = f.read()
+        self.files[path] = hashlib.sha256(source).hexdigest()
+
+        self._stack.append(path)
+        script = []
+        parsed = self._parsed.pop(path, None)
+        if parsed is None:
+            parsed = parse_script(source.decode(), self.lazy)
+        for i in parsed:
+            if isinstance(i, Include):
+                script += self.load(self._resolve(i.path, path))
+            else:
+                script.append(i)
+        self._stack.pop()
 
-    def sub(self, s):
-        item1, _op, item2 = s
-        return Op(sub, item1, item2)
+        self._loaded[path] = script
+        return script
 
-    def mul(self, s):
-        item1, _op, item2 = s
-        return Op(mul, item1, item2)
+    def _prefetch(self, path, source):
+        """
+        Find the included files with the INCLUDE statements and parse all
+        of them in parallel. The files that can't be read or parsed here
+        are loaded again serially, so the errors are raised there.
+        """
+
+        pending = [(path, source)]
+        while pending:
+            path, source = pending.pop()
+            if path in self._sources:
+                continue
+            if source is None:
+                try:
+                    with open(path, "rb") as f:
+                        source = f.read()
+                except OSError:
+                    continue
 
-    def div(self, s):
-        item1, _op, item2 = s
-        return Op(div, item1, item2)
+            self._sources[path] = source
+            for match in INCLUDERE.finditer(source.decode(errors="replace")):
+                include = self._resolve(match.group("path"), path)
+                pending.append((os.path.abspath(include), None))
+
+        if len(self._sources) < 2:
+            return
+
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        # fork isn't safe here, the listener and command threads could be
+        # running
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context(
+            "forkserver" if "forkserver" in methods else "spawn")
+
+        paths = list(self._sources)
+        with ProcessPoolExecutor(max_workers=min(self.jobs, len(paths)),
+                                 mp_context=context) as executor:
+            futures = [executor.submit(parse_script, self._sources[i].decode(), self.lazy)
+                       for i in paths]
+            for path, future in zip(paths, futures):
+                try:
+                    self._parsed[path] = future.result()
+                except Exception:
+                    pass
+
+    def _resolve(self, include, parent):
+        if os.path.isabs(include):
+            return include
+
+        path = os.path.join(os.path.dirname(parent), include)
+        # Old scripts use paths relative to the current working directory
+        if not os.path.exists(path) and os.path.exists(include):
+            return include
+        return path
+
+
+class Story:
+    """
+    Compiled ink script
+
+    The story content is shared by all the sessions running it, so it should
+    never be modified once it's loaded. Use Story.load to reuse the same
+    story object for a file.
+
+    With lazy, each knot is parsed the first time it's used, and the
+    compiled cache is not used. The errors in the knots are only found when
+    they are loaded, call validate() to load all of them. With jobs > 1 the
+    included files are parsed in parallel in that number of processes.
+    """
+
+    _stories = weakref.WeakValueDictionary()
+    _lock = threading.Lock()
+
+    def __init__(self, path, use_cache=True, lazy=False, jobs=1):
+        self.path = os.path.abspath(path)
+        self.lazy = lazy
+        self.jobs = jobs
+        self._use_cache = use_cache and not lazy
+        self._knots_lock = threading.Lock()
+        # Source files of the script, including the included ones, with the
+        # content digest {path: digest}
+        self.files = {}
+
+        # All script knots will go here, the default one has no name
+        self.knots = {
+            "": Knot.empty(name=""),
+            "END": Knot.empty(name="END"),
+        }
 
-    def neg(self, s):
-        _op, item1 = s
-        return Op(neg, item1, None)
+        self.script = self._load()
+        self.declarations = [i for i in self.script
+                             if isinstance(i, Assignment) and i.declaration]
+        self._parse_knots(self.script)
+        self._build_addresses()
+        self._link()
 
-    def variable(self, s):
-        assignment = s[1]
-        assignment.declaration = True
-        return assignment
+        files = "".join(f"{p}:{d}" for p, d in sorted(self.files.items()))
+        self.digest = hashlib.sha256(files.encode()).hexdigest()
 
-    def operation(self, s):
-        assignment = s[1]
-        assignment.declaration = False
-        return assignment
+    @classmethod
+    def load(cls, path, use_cache=True, lazy=False, jobs=1):
+        """
+        Returns the story for the path, reusing the already loaded story if
+        none of the source files changed. Lazy and eager stories are loaded
+        separately, jobs and use_cache only change how a story is loaded.
+        """
 
-    def assignment(self, s):
-        name, value = s
-        return Assignment(var=name.value.strip(), value=value)
+        key = (os.path.abspath(path), bool(lazy))
+        with cls._lock:
+            story = cls._stories.get(key)
+            if story and story.is_current():
+                return story
+            story = cls(key[0], use_cache=use_cache, lazy=lazy, jobs=jobs)
+            cls._stories[key] = story
+            return story
 
-    def str(self, s):
-        (s, ) = s
-        return s.value[1:-1]
+    def is_current(self):
+        return all(cache.file_digest(p) == d for p, d in self.files.items())
 
-    def number(self, s):
-        (s, ) = s
-        return float(s.value)
+    def _load(self):
+        """
+        Load the compiled script from the cache if any of the source files
+        changed, or parse it otherwise and store it in the cache
+        """
 
-    def include(self, s):
-        _include, filename, *rest = self.discard_newlines(s)
-        path = filename.value.strip()
-        script = InkScript(path)
+        with open(self.path, "rb") as f:
+            source = f.read()
+
+        digest = hashlib.sha256(source).hexdigest()
+        key = hashlib.sha256(f"{self.path}:{digest}".encode()).hexdigest()
+        name = os.path.join("stories", f"{key}.pickle")
+
+        compiled = cache.load(name) if self._use_cache else None
+        if self._is_valid(compiled):
+            self.files = compiled["files"]
+            return compiled["script"]
+
+        resolver = IncludeResolver(lazy=self.lazy, jobs=self.jobs)
+        script = resolver.load(self.path, source)
+        self.files = resolver.files
+        if self._use_cache:
+            cache.store(name, {
+                "version": COMPILED_VERSION,
+                "files": self.files,
+                "script": script,
+            })
         return script
 
-    def tag(self, s):
-        return s[0]
+    def _is_valid(self, compiled):
+        if not compiled or compiled.get("version") != COMPILED_VERSION:
+            return False
+        files = compiled["files"]
+        return all(cache.file_digest(p) == d for p, d in files.items())
 
-    def text(self, s):
-        lines = []
-        texts = Texts(content=lines, divert=None)
-        glue_start = False
-        newlines = 0
+    def _parse_knots(self, script):
+        """
+        Fill the self.knots property with the content in the tree
+        """
 
-        for i in s:
+        default_knot = self.knots[""]
+        for i in script:
             match i:
-                case(Token(type="GLUESTART")):
-                    glue_start = True
-                case(Token(type="GLUEEND")):
-                    lines[-1].glue_end = True
-                case(Token(type="SH_COMMENT")):
-                    lines[-1].tag = i.value[1:].strip()
-                case(Divert()):
-                    i.inline = True
-                    texts.divert = i
-                case(Token(type="NEWLINE")):
-                    # paragraph
-                    if newlines == 2:
-                        lines.append(Text(text=""))
-                    else:
-                        newlines += 1
-                        continue
-                case(Token(type="STRING")):
-                    text = i.value.strip()
-                    if lines and lines[-1].glue_end:
-                        lines[-1].text += f" {text}"
-                        lines[-1].glue_end = False
-                        continue
-
-                    lines.append(Text(text=text, tag="", glue_start=glue_start))
-                    glue_start = False
-
-            newlines = 0
-        return texts
-
-    def eq(self, s):
-        op1, _eq, op2 = s
-        return Condition(operator=eq, item1=op1, item2=op2)
-
-    def lt(self, s):
-        op1, _op, op2 = s
-        return Condition(operator=lt, item1=op1, item2=op2)
-
-    def gt(self, s):
-        op1, _op, op2 = s
-        return Condition(operator=gt, item1=op1, item2=op2)
-
-    def gte(self, s):
-        op1, _op, op2 = s
-        return Condition(operator=ge, item1=op1, item2=op2)
-
-    def lte(self, s):
-        op1, _op, op2 = s
-        return Condition(operator=le, item1=op1, item2=op2)
-
-    def and_(self, s):
-        op1, _op, op2 = s
-        return Condition(operator=and_, item1=op1, item2=op2)
-
-    def or_(self, s):
-        op1, _op, op2 = s
-        return Condition(operator=or_, item1=op1, item2=op2)
-
-    def not_(self, s):
-        _op, op1 = s
-        return Condition(operator=not_, item1=op1, item2=None)
-
-    def logic(self, s):
-        _start, operation, _end = s
-        if not isinstance(operation, Condition):
-            return Condition(operator=truth, item1=operation, item2=None)
-        return operation
-
-    def opttext(self, s):
-        display_text = ""
-        pre = ""
-        suppress = ""
-        post = ""
-        tag = ""
-        divert = None
-        logic = None
-
-        for i in s:
-            if isinstance(i, Divert):
-                divert = i
-            elif isinstance(i, Condition):
-                logic = i
-            elif i.type == "OPTSTRING":
-                pre = i.value
-            elif i.type == "OPTSUPPRESS":
-                suppress = i.value
-            elif i.type == "OPTPOST":
-                post = i.value
-            elif i.type == "SH_COMMENT":
-                tag = i.value[1:].strip()
-
-        # Suppress text, option is the pre + suppress text and display_text is pre + post
-        option = f"{pre}{suppress}"
-        display_text = f"{pre}{post}"
-        fulltext = f"{option}{display_text}"
-
-        return (fulltext.strip(), option.strip(), display_text.strip(), tag, divert, logic)
-
-    def option(self, s):
-        _opt, opttext, *content = self.discard_newlines(s)
-        content = self.discard_newlines(content)
-        (fulltext, option, display_text, tag, divert, logic) = opttext
-        text = Text(text=fulltext, tag=tag)
-        # If there's a divert in the option, the followed content is ignored
-        if divert:
-            content = [divert]
-        return Option(content=content, text=text, display_text=display_text, option=option, logic=logic)
-
-    def options(self, s):
-        return s
-
-    def start(self, s):
-        return s
-
-    def knotheader(self, s):
-        knot, name = s
-        return name.value.strip()
-
-    def content(self, s):
-        return s
-
-    def knot(self, s):
-        header, content, *rest = self.discard_newlines(s)
-        content = self.discard_newlines(content)
-        rest = self.discard_newlines(rest)
-        stitches = {}
-        if isinstance(content, Stitch):
-            default_stitch = content
-            content = default_stitch.content
-            stitches[default_stitch.name] = default_stitch
-        if rest:
-            stitches.update({i.name: i for i in rest})
-        return Knot(content=content, name=header, stitches=stitches)
-
-    def stitchheader(self, s):
-        stitch, name = s
-        return name.value.strip()
-
-    def stitch(self, s):
-        header, content = self.discard_newlines(s)
-        content = self.discard_newlines(content)
-        return Stitch(name=header, content=content)
-
-    def divert(self, s):
-        ((knot, stitch), ) = s
-        return Divert(to=knot, stitch=stitch)
-
-    def divert_stitch(self, s):
-        _dot, stich_name = s
-        return stich_name.value.strip()
-
-    def divert_name(self, s):
-        knot, *stitch = s
-        stitch = stitch[0] if stitch else None
-        return (knot.value.strip(), stitch)
-
-    def NDIVERT(self, token):
-        return Discard
-
-    def WS_INLINE(self, token):
-        return Discard
-
-    def is_newline(self, l):
-        return isinstance(l, Token) and l.type == "NEWLINE"
-
-    def discard_newlines(self, l):
-        if not isinstance(l, list):
-            return l
-        return [i for i in l if not self.is_newline(i)]
-
-
-class InkScript:
-    def __init__(self, path, on_change=None):
-        self._ink_path = path
+                case Knot() | KnotSource():
+                    self.knots[i.name] = i
+                    continue
+            default_knot.content.append(i)
+
+    def _build_addresses(self):
+        """
+        Assign an index to each knot and stitch, used as divert target and
+        to store the visit counts
+        """
+
+        # [(name, content)], the content is None for knots not loaded yet
+        self.targets = []
+        # {name: index}
+        self.addresses = {}
+        for knot in self.knots.values():
+            self.addresses[knot.name] = len(self.targets)
+            if isinstance(knot, KnotSource):
+                self.targets.append((knot.name, None))
+                stitches = [(name, None) for name in knot.stitches]
+            else:
+                self.targets.append((knot.name, knot))
+                stitches = [(i.name, i) for i in knot.stitches.values()]
+
+            for stitch, content in stitches:
+                name = f"{knot.name}.{stitch}"
+                self.addresses[name] = len(self.targets)
+                self.targets.append((name, content))
+
+    def content(self, address):
+        """
+        Returns the knot or stitch content in the address, loading the knot
+        if needed
+        """
+
+        name, content = self.targets[address]
+        if content is None:
+            self._load_knot(name.partition(".")[0])
+            name, content = self.targets[address]
+        return content
+
+    def _load_knot(self, name):
+        with self._knots_lock:
+            source = self.knots[name]
+            if not isinstance(source, KnotSource):
+                return
+
+            knots = [i for i in parse(source.source) if isinstance(i, Knot)]
+            knot = knots[0] if len(knots) == 1 else None
+            if not knot or knot.name != name or list(knot.stitches) != source.stitches:
+                raise InkError(f"The knot '{name}' can't be loaded lazily")
+            self._link_knot(knot)
+
+            address = self.addresses[name]
+            self.targets[address] = (name, knot)
+            for stitch in knot.stitches.values():
+                stitch_name = f"{name}.{stitch.name}"
+                self.targets[self.addresses[stitch_name]] = (stitch_name, stitch)
+            self.knots[name] = knot
+
+    def validate(self):
+        """
+        Load all the knots, so all the errors in the script are found
+        """
+
+        for name, knot in list(self.knots.items()):
+            if isinstance(knot, KnotSource):
+                self._load_knot(name)
+
+    def _link(self):
+        """
+        Resolve all the diverts and compile all the expressions and tags in
+        the script, so nothing is looked up by name during the script
+        execution
+        """
+
+        for knot in self.knots.values():
+            if isinstance(knot, Knot):
+                self._link_knot(knot)
+
+    def _link_knot(self, knot):
+        self._link_content(knot.content, knot)
+        for stitch in knot.stitches.values():
+            self._link_content(stitch.content, knot)
+
+    def _link_content(self, content, knot):
+        for i in content:
+            match i:
+                case Divert():
+                    self._resolve_divert(i, knot)
+                case Texts():
+                    for text in i:
+                        self._compile_tag(text, knot)
+                    if i.divert:
+                        self._resolve_divert(i.divert, knot)
+                case Text():
+                    self._compile_tag(i, knot)
+                case [Option(), *others]:
+                    for option in i:
+                        self._compile_tag(option.text, knot)
+                        if option.logic:
+                            option.logic.link(self.addresses)
+                        self._link_content(option.content, knot)
+                case Evaluable():
+                    i.link(self.addresses)
+
+    def _compile_tag(self, text, knot):
+        try:
+            text.command, text.listener = compile_tag(text.tag)
+        except UnknownTag as e:
+            where = f"knot '{knot.name}'" if knot.name else "the script"
+            warnings.warn(f"{e} in {where}: {text.tag}", InkWarning)
+
+    def _resolve_divert(self, divert, knot):
+        addresses = self.addresses
+        if divert.to in self.knots:
+            name = divert.to
+            visits = [addresses[name]]
+            if divert.stitch:
+                name = f"{name}.{divert.stitch}"
+        else:
+            # local divert to a stitch
+            name = f"{knot.name}.{divert.to}"
+            visits = []
+
+        if name not in addresses:
+            where = f"knot '{knot.name}'" if knot.name else "the script"
+            raise InkError(f"Unknown divert target '{str(divert)[3:]}' in {where}")
+
+        divert.address = addresses[name]
+        if divert.address not in visits:
+            visits.append(divert.address)
+        divert.visits = tuple(visits)
+
+
+class Options(list):
+    """
+    Options yielded by Session.stream, with the question they're for
+    """
+
+    def __init__(self, options, question):
+        super().__init__(options)
+        self.question = question
+
+
+class Session:
+    """
+    Runtime state of a story, several sessions can run the same story at the
+    same time
+
+    All the changes in the session state (run, choose, set and the listener
+    resolutions) go through a queue, that is drained by one thread at a time.
+    The dispatch function, like GLib.idle_add, is used to drain the queue
+    in the loop of the thread that created the session when the changes are
+    requested from other threads, otherwise the calling thread drains it.
+
+    With debounce, on_change is called at most once every debounce seconds
+    with the last output, instead of once for each change.
+    """
+
+    def __init__(self, story, on_change=None, dispatch=None, debounce=None):
+        self._story = story
         self._step = 0
         self._output = []
         self._options = []
         self._allopts = []
-        self._parser = self._init_parser()
-        self._transformer = InkTransformer()
-        self._script = None
+        # Indexes of the available options in all the options
+        self._available = []
         self._vars = {}
+        self._visits = None
         self._question = 0
         self._on_change = on_change
         self.finished = False
         self.glue = False
 
-        # All script knots will go here, the default one has no name
-        self._knots = {
-            "": Knot.empty(name=""),
-            "END": Knot.empty(name="END"),
-        }
-
-        with open(self._ink_path) as f:
-            self._tree = self._parser.parse(f.read())
-            self._script = self._transformer.transform(self._tree)
-            self._script = self._parse_include(self._script)
-            self._parse_knots(self._script)
-            self._init_vars()
-            self._current_knot = self._knots[""]
-            self._current_stitch = None
-
-    def _parse_include(self, script):
-        new_script = []
-        for i in script:
-            if isinstance(i, InkScript):
-                new_script += i._script
-            else:
-                new_script.append(i)
-        return new_script
-
-    def _init_parser(self):
-        grammar = os.path.join(os.path.dirname(__file__), "ink.lark")
-        return Lark.open(grammar, parser='lalr')
+        # Pending changes [(function, args, future)], the future is None if
+        # nobody waits for the change
+        self._queue = deque()
+        self._writer = threading.Lock()
+        # Thread draining the queue
+        self._writer_thread = None
+        self._dispatch = dispatch
+        self._owner_thread = threading.get_ident()
+
+        # Variables set in the current transaction of each thread,
+        # {name: value} in the batch attribute
+        self._transactions = threading.local()
+        self._debounce = debounce
+        self._notify_timer = None
 
-    def _parse_knots(self, script):
-        """
-        Fill the self._knots property with the content in the tree
-        """
+        self._init_vars()
+        self._address = story.addresses[""]
+        self._content = story.knots[""]
 
-        self._default_knot = self._knots[""]
-        for i in script:
-            match i:
-                case Knot():
-                    self._knots[i.name] = i
-                    continue
-            self._default_knot.content.append(i)
+    @property
+    def story(self):
+        return self._story
 
     def _init_vars(self):
         self._vars = {}
-        for i in self._script:
-            match i:
-                case Assignment(var=n, value=v, declaration=True):
-                    self._vars[n] = i.evaluate(self._vars)
-        for k, v in self._knots.items():
-            self._vars[k] = 0
-            for s in v.stitches:
-                self._vars[f"{k}.{s}"] = 0
+        self._visits = array("I", [0]) * len(self._story.targets)
+        for i in self._story.declarations:
+            self._vars[i.var] = i.evaluate(self._vars, self._visits)
 
     @property
     def output(self):
@@ -491,38 +851,264 @@ class InkScript:
 
     @property
     def vars(self):
-        return self._vars
+        """
+        Script variables and the visit counts of each knot and stitch
+        """
+
+        targets = self._story.targets
+        visits = {name: self._visits[i] for i, (name, _) in enumerate(targets)}
+        return {**self._vars, **visits}
 
     def var(self, name, default=None):
+        batch = self._batch()
+        if batch and name in batch:
+            return batch[name]
+        addresses = self._story.addresses
+        if name in addresses:
+            return self._visits[addresses[name]]
         return self._vars.get(name, default)
 
     def set(self, name, value):
-        self._vars[name] = value
-        # Update options
-        self._set_options(self._allopts)
+        batch = self._batch()
+        if batch is not None:
+            batch[name] = value
+            return
+        self.set_many({name: value})
+
+    def set_many(self, values):
+        """
+        Set several variables, the options are updated and on_change is
+        called only once. The knot and stitch names are the visit counts,
+        that must be non negative integers.
+        """
+
+        values = dict(values)
+        addresses = self._story.addresses
+        for name, value in values.items():
+            if name in addresses:
+                values[name] = self._visit_count(name, value)
+        self._post(self._set_many, values)
+
+    @staticmethod
+    def _visit_count(name, value):
+        try:
+            count = int(value)
+        except (TypeError, ValueError):
+            count = None
+        if count is None or count != value or not 0 <= count < 2 ** 32:
+            raise InkError(f"Invalid visit count for '{name}': {value!r}")
+        return count
+
+    def _batch(self):
+        return getattr(self._transactions, "batch", None)
+
+    @contextmanager
+    def transaction(self):
+        """
+        The variables set in the block are set together with set_many at
+        the end of the block, or discarded if there's an exception
+        """
+
+        if self._batch() is not None:
+            # nested transaction, it's applied with the outer one
+            yield self
+            return
+
+        self._transactions.batch = {}
+        try:
+            yield self
+            values = self._transactions.batch
+        finally:
+            self._transactions.batch = None
+        if values:
+            self.set_many(values)
+
+    def _set_many(self, values):
+        addresses = self._story.addresses
+        for name, value in values.items():
+            if name in addresses:
+                self._visits[addresses[name]] = value
+            else:
+                self._vars[name] = value
+        self._update_options(values.keys())
         self._changed()
 
+    def save_state(self):
+        """
+        Returns a compact snapshot of the session state as bytes, that can
+        be restored with load_state in a session of the same story
+        """
+
+        visits = []
+        for i, count in enumerate(self._visits):
+            if count:
+                visits += [i, count]
+        options = [i for i, opt in enumerate(self._allopts)
+                   if any(opt is o for o in self._options)]
+
+        state = {
+            "version": STATE_VERSION,
+            "story": self._story.digest,
+            "address": self._address,
+            "step": self._step,
+            "question": self._question,
+            "finished": self.finished,
+            "glue": self.glue,
+            "vars": self._vars,
+            # only the visited addresses, as [index, count, ...]
+            "visits": visits,
+            "options": options,
+            "output": [[i.text, i.tag, i.reply] for i in self._output],
+        }
+        return json.dumps(state, separators=(",", ":")).encode()
+
+    def load_state(self, data):
+        """
+        Restore the session state from a save_state snapshot
+        """
+
+        state = json.loads(data)
+        if state.get("version") != STATE_VERSION:
+            raise InkError(f"Unsupported session state version {state.get('version')}")
+        if state["story"] != self._story.digest:
+            raise InkError("The session state was saved for a different story")
+
+        self._address = state["address"]
+        self._content = self._story.content(self._address)
+        self._step = state["step"]
+        self._question = state["question"]
+        self.finished = state["finished"]
+        self.glue = state["glue"]
+        self._vars = state["vars"]
+
+        self._visits = array("I", [0]) * len(self._story.targets)
+        visits = state["visits"]
+        for i in range(0, len(visits), 2):
+            self._visits[visits[i]] = visits[i + 1]
+
+        self._output = [Text(text=text, tag=tag, reply=reply)
+                        for text, tag, reply in state["output"]]
+
+        self._allopts = []
+        if self._step < len(self._content):
+            match self._content[self._step]:
+                case [Option(), *others] as options:
+                    self._allopts = options
+        self._available = state["options"]
+        self._options = [self._allopts[i] for i in self._available]
+        self._run_listeners(state["options"])
+
     def resolve(self, index, question):
-        # Only choose the option if the question didn't change
-        if self._question == question:
-            self.choose(index)
+        """
+        Choose the option in the index of all the current options, if the
+        question didn't change and the option is still available
+        """
+
+        # Listeners for old questions are dropped without waiting
+        if self._question != question:
+            return
+        self._post(self._resolve, index, question)
+
+    def _resolve(self, index, question):
+        if self._question != question or index >= len(self._allopts):
+            return
+
+        option = self._allopts[index]
+        for i, opt in enumerate(self._options):
+            if opt is option:
+                self._choose(i)
+                return
+
+    def _post(self, fn, *args):
+        """
+        Add a change to the queue and drain it, or dispatch it to the owner
+        loop if this is not the thread that created the session. The change
+        exceptions are raised here, unless it's dispatched or posted while
+        running other change, then they're raised by the thread draining
+        the queue once it's empty.
+        """
+
+        thread = threading.get_ident()
+        if self._writer_thread == thread:
+            # Called while running other change, it runs after it
+            self._queue.append((fn, args, None))
+            return
+        if self._dispatch and thread != self._owner_thread:
+            self._queue.append((fn, args, None))
+            self._dispatch(self._drain)
+            return
+
+        future = Future()
+        self._queue.append((fn, args, future))
+        self._drain()
+        # other thread could be draining the queue and running this change
+        future.result()
+
+    def _drain(self):
+        error = None
+        while self._queue:
+            with self._writer:
+                self._writer_thread = threading.get_ident()
+                try:
+                    while self._queue:
+                        fn, args, future = self._queue.popleft()
+                        try:
+                            fn(*args)
+                        except BaseException as e:
+                            if future is None:
+                                error = error or e
+                            else:
+                                future.set_exception(e)
+                        else:
+                            if future is not None:
+                                future.set_result(None)
+                finally:
+                    self._writer_thread = None
+        if error:
+            raise error
+        # Remove the GLib.idle_add source
+        return False
 
     def _changed(self):
-        if self._on_change:
+        if not self._on_change:
+            return
+        if not self._debounce:
             self._on_change(self.output)
+            return
+
+        if self._notify_timer is None:
+            self._notify_timer = threading.Timer(self._debounce, self._post,
+                                                 args=(self._notify, ))
+            self._notify_timer.daemon = True
+            self._notify_timer.start()
+
+    def _notify(self):
+        self._notify_timer = None
+        self._on_change(self.output)
 
     def choose(self, option=None):
+        self._post(self._choose, option)
+
+    def _choose(self, option=None):
+        self._start_choose(option)
+        self._go_next()
+        self._changed()
+
+    def _start_choose(self, option):
         # TODO: Remove option for next runs
         # https://github.com/inkle/ink/blob/master/Documentation/WritingWithInk.md#choices-can-only-be-used-once
-        opt = self.options[option]
+        if not isinstance(option, int) or not 0 <= option < len(self._options):
+            raise InkError(f"No valid option {option!r}")
+        opt = self._options[option]
         content = opt.content
-        opt.run_command()
+        opt.run_command(self)
 
         self._output = []
         if opt.display_text:
             self._output += [Text(text=opt.display_text, tag=opt.text.tag, reply=True)]
 
         self._question += 1
+        cancel_listeners(self)
         divert = None
 
         for i in content:
@@ -530,26 +1116,99 @@ class InkScript:
                 case Texts(content=content):
                     self._output += content
                 case Assignment():
-                    self._vars[i.var] = i.evaluate(self._vars)
+                    self._vars[i.var] = i.evaluate(self._vars, self._visits)
                 case Divert():
                     divert = i
                     break
 
         if divert:
             self._go_to_divert(divert)
+        self._clear_options()
+
+    def run(self):
+        self._post(self._run)
+        return self.output
+
+    def stream(self, option=None):
+        """
+        Run the script, or choose the option, yielding each output line as
+        soon as it's produced, and then the Options, that are empty if the
+        script is finished, with the question they're for. A line is yielded when the next line is
+        produced, because the next line could be glued to it.
+
+        Each script step is a change in the session queue, if other change
+        moves the script to other question, like a listener choosing an
+        option, the iteration stops.
+        """
+
+        thread = threading.get_ident()
+        if self._writer_thread == thread or (self._dispatch and thread != self._owner_thread):
+            raise InkError("The session can only be streamed from its thread")
+
+        if option is None:
+            self._post(self._start_run)
         else:
-            self._go_next()
+            self._post(self._start_choose, option)
+        question = self._question
+
+        done = []
+        # output of this question, other changes could replace it between
+        # the steps
+        output = []
+
+        def step():
+            nonlocal output
+            if self._question != question:
+                done.append(None)
+                return
+            finished = self._next_step()
+            output = self._output
+            if finished:
+                done.append((output[sent:], Options(self._options, self._question)))
+                if option is not None:
+                    self._changed()
+
+        sent = 0
+        while True:
+            self._post(step)
+            if done:
+                break
+            # the last line could be glued to the next one
+            while sent < len(output) - 1:
+                yield output[sent]
+                sent += 1
+
+        if done[0] is None:
+            return
+        lines, options = done[0]
+        yield from lines
+        yield options
+
+    async def astream(self, option=None):
+        """
+        Async version of stream, the loop runs other tasks between lines
+        """
 
-        self._changed()
+        import asyncio
 
-    def run(self):
+        for item in self.stream(option):
+            yield item
+            await asyncio.sleep(0)
+
+    def _run(self):
+        self._start_run()
+        self._go_next()
+
+    def _start_run(self):
+        self._question += 1
+        cancel_listeners(self)
         self._step = 0
         self._output = []
-        self._current_knot = self._knots[""]
-        self._current_stitch = None
+        self._address = self._story.addresses[""]
+        self._content = self._story.knots[""]
         self.glue = False
         self._init_vars()
-        return self._go_next()
+        self._clear_options()
 
     def _add_output(self, texts):
         # check glue
@@ -557,7 +1216,8 @@ class InkScript:
             last = self._output[-1]
             head, *texts = texts
             if self.glue or last.glue_end or head.glue_start:
-                last.text += f" {head}"
+                # The story texts are shared, so the glued line is a new one
+                self._output[-1] = replace(last, text=f"{last.text} {head}")
                 self.glue = False
             else:
                 texts = [head, *texts]
@@ -567,68 +1227,111 @@ class InkScript:
     def _go_to_divert(self, divert):
         # TODO: store the prev knot somewhere to be able to go back?
         self._step = 0
-        self._current_stitch = None
-        if divert.to in self._knots:
-            self._current_knot = self._knots[divert.to]
-            self._current_stitch = divert.stitch
-            self._vars[divert.to] += 1
-            if divert.stitch:
-                self._vars[f"{divert.to}.{divert.stitch}"] += 1
-        else:
-            # maybe a local divert to a stitch
-            self._current_stitch = divert.to
-            k = self._current_knot.name
-            self._vars[f"{k}.{divert.to}"] += 1
-
-        return self._go_next()
+        self._address = divert.address
+        self._content = self._story.content(divert.address)
+        for i in divert.visits:
+            self._visits[i] += 1
 
     def _set_options(self, options):
         self._allopts = options
-        self._options = [opt for opt in options if opt.is_available(self._vars)]
-        for i, option in enumerate(self._options):
-            option.run_listeners(self, i, self._question)
+        available = [i for i, opt in enumerate(options)
+                     if opt.is_available(self._vars, self._visits)]
+        self._available = available
+        self._options = [options[i] for i in available]
+        self._run_listeners(available)
 
-    def _go_next(self):
+    def _update_options(self, names):
         """
-        Recursive function that loads the next state until it requires user
-        input
+        Evaluate again the options that depend on the changed variables, the
+        options and their listeners are only updated if any of them changes
         """
 
+        visible = set(self._available)
+        changes = {}
+        for i, opt in enumerate(self._allopts):
+            if opt.deps.isdisjoint(names):
+                continue
+            available = bool(opt.is_available(self._vars, self._visits))
+            if available != (i in visible):
+                changes[i] = available
+        if not changes:
+            return
+
+        options = self._allopts
+        available = [i for i in range(len(options)) if changes.get(i, i in visible)]
+        self._available = available
+        self._options = [options[i] for i in available]
+        self._run_listeners(available)
+
+    def _run_listeners(self, available):
+        """
+        Start the listeners of the available options, that are the indexes
+        in all the options, and cancel the rest
+        """
+
+        for i in available:
+            self._allopts[i].run_listeners(self, i, self._question)
+        cancel_listeners(self, self._question, keep=available)
+
+    def _clear_options(self):
         self._allopts = []
         self._options = []
+        self._available = []
 
-        if self._current_stitch:
-            stitch = self._current_knot.stitches[self._current_stitch]
-            # No more steps in this stitch, so it's completed
-            if self._step >= len(stitch):
-                self.finished = True
-                return self.output
-            step = stitch[self._step]
-        else:
-            # No more steps in this knot, so it's completed
-            if self._step >= len(self._current_knot):
-                self.finished = True
-                return self.output
-            step = self._current_knot[self._step]
+    def _go_next(self):
+        """
+        Runs the script steps from the current position until it requires
+        user input or the current knot or stitch is completed
+        """
 
+        while not self._next_step():
+            pass
+        return self.output
+
+    def _next_step(self):
+        """
+        Runs the next script step, returns True if the script requires user
+        input or the current knot or stitch is completed
+        """
+
+        content = self._content
+        # No more steps in this knot or stitch, so it's completed
+        if self._step >= len(content):
+            self.finished = True
+            return True
+
+        step = content[self._step]
+        divert = None
         match step:
             case Divert():
-                if step.inline:
-                    self.glue = True
-                return self._go_to_divert(step)
+                divert = step
             case [Option(), *others]:
                 self._set_options(step)
-                return self.output
+                return True
             case Texts():
                 self._add_output(step.content)
-                if step.divert:
-                    if step.divert.inline:
-                        self.glue = True
-                    return self._go_to_divert(step.divert)
+                divert = step.divert
             case Text():
                 self._add_output([step])
             case Assignment(declaration=False):
-                self._vars[step.var] = step.evaluate(self._vars)
+                self._vars[step.var] = step.evaluate(self._vars, self._visits)
+
+        if divert:
+            if divert.inline:
+                self.glue = True
+            self._go_to_divert(divert)
+        else:
+            self._step += 1
+        return False
+
+
+class InkScript(Session):
+    """
+    Session for the ink script in the path
+    """
 
-        self._step += 1
-        return self._go_next()
+    def __init__(self, path, on_change=None, use_cache=True, lazy=False,
+                 jobs=1, dispatch=None, debounce=None):
+        story = Story.load(path, use_cache=use_cache, lazy=lazy, jobs=jobs)
+        super().__init__(story, on_change=on_change, dispatch=dispatch,
+                         debounce=debounce)
@@ -1,111 +1,134 @@
-import re
-import asyncio
 import threading
-import subprocess
+import weakref
 
-import pathlib
-
-
-LISTENRE = re.compile(r"^wait-?(?P<command>[^:]*):\s*(?P<args>([^\s]+\s*)+)$")
+# asyncio and the modules used by the listeners are imported on the first
+# use, so scripts without listeners don't pay for them
 
 
 def _start_listeners_loop():
+    import asyncio
+
     loop = asyncio.new_event_loop()
-    t = threading.Thread(target=loop.run_forever)
+    t = threading.Thread(target=loop.run_forever, name="lils-listeners")
     t.daemon = True
     t.start()
     return loop
 
 
-_LOOP = _start_listeners_loop()
-background_tasks = set()
+# The listeners loop thread is started with the first listener
+_LOOP = None
+# Running listeners by script, so cancelling only looks at the listeners
+# of one script {script: {(question, option index): task}}
+_LISTENERS = weakref.WeakKeyDictionary()
+_LISTENERS_LOCK = threading.Lock()
 
 
-async def wait_test(script, index, question, args):
+# Listeners
+
+
+async def wait_test(script, index, question, args, **options):
     script.resolve(index, question)
 
 
-async def wait_(script, index, question, args):
+async def wait_(script, index, question, args, **options):
+    import asyncio
+
     t = int(args)
     await asyncio.sleep(t / 1000)
     script.resolve(index, question)
 
 
-async def wait_newfile(script, index, question, path):
+async def wait_newfile(script, index, question, path, **options):
     """
     Wait for file creation
     """
 
-    p = pathlib.Path(path)
+    from .watch import wait_created
 
-    while True:
-        if script._question != question:
-            return
-
-        if p.exists():
-            break
-        await asyncio.sleep(0.2)
+    await wait_created(path, **options)
     script.resolve(index, question)
 
 
-async def wait_infile(script, index, question, args):
+async def wait_infile(script, index, question, args, **options):
     """
-    Wait for text inside a file, the text should be literal
+    Wait for text inside a file, the text is literal or a regular expression
+    between slashes: /regex/
     """
 
-    path, *rest = args.split(" ")
-    line = " ".join(rest)
-    p = pathlib.Path(path)
+    from .watch import wait_content, LiteralMatch, RegexMatch
 
-    while True:
-        if script._question != question:
-            return
+    path, *rest = args.split(" ")
+    text = " ".join(rest)
+    if len(text) > 1 and text.startswith("/") and text.endswith("/"):
+        matcher = RegexMatch(text[1:-1])
+    else:
+        matcher = LiteralMatch(text)
 
-        content = ""
-        with open(path) as f:
-            content = f.read()
-        if p.exists() and line in content:
-            break
-        await asyncio.sleep(1)
+    await wait_content(path, matcher, **options)
     script.resolve(index, question)
 
 
-async def wait_ps(script, index, question, args):
+async def wait_ps(script, index, question, args, **options):
     """
-    Wait for a line of text appearing in ps -eaf
+    Wait for a running process with the text in its command line
     """
 
-    while True:
-        if script._question != question:
-            return
-
-        content = subprocess.check_output(["ps", "-eaf"])
-        if args in content.decode():
-            break
-        await asyncio.sleep(1)
+    from .procs import process_sampler
 
+    await process_sampler().wait(args, **options)
     script.resolve(index, question)
 
 
-def run_listeners(command_line, script, index, question):
-    if not command_line:
+def run_listeners(listener, script, index, question):
+    global _LOOP
+
+    import asyncio
+
+    if not listener:
         return
 
-    match = LISTENRE.match(command_line)
-    if not match:
+    fn = listener.handler
+    if not fn:
         return
 
-    command = match.group("command")
-    args = match.group("args")
+    key = (question, index)
+    with _LISTENERS_LOCK:
+        running = _LISTENERS.setdefault(script, {})
+        # The listener for this option is already running
+        if key in running:
+            return
+
+        if _LOOP is None:
+            _LOOP = _start_listeners_loop()
 
-    command = f"wait_{command}"
-    if command in globals():
-        fn = globals()[command]
-        args = (script, index, question, args)
-        task = asyncio.run_coroutine_threadsafe(fn(*args), _LOOP)
-        task.add_done_callback(discard_task)
-        background_tasks.add(task)
+        args = (script, index, question, listener.args)
+        task = asyncio.run_coroutine_threadsafe(fn(*args, **listener.options), _LOOP)
+        running[key] = task
+    task.add_done_callback(lambda t: _discard_task(script, key, t))
 
 
-def discard_task(task):
-    background_tasks.discard(task)
+def cancel_listeners(script, question=None, keep=()):
+    """
+    Cancel the running listeners of the script, except the ones for the
+    options in keep for the question
+    """
+
+    with _LISTENERS_LOCK:
+        running = _LISTENERS.get(script)
+        if not running:
+            return
+        keys = [k for k in running if k[0] != question or k[1] not in keep]
+        tasks = [running.pop(k) for k in keys]
+        if not running:
+            del _LISTENERS[script]
+    for task in tasks:
+        task.cancel()
+
+
+def _discard_task(script, key, task):
+    with _LISTENERS_LOCK:
+        running = _LISTENERS.get(script)
+        if running and running.get(key) is task:
+            del running[key]
+            if not running:
+                del _LISTENERS[script]
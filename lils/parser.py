@@ -0,0 +1,281 @@
+import os
+import threading
+
+from lark import Lark
+from lark import Token
+from lark import Transformer
+
+from operator import add, sub, mul, truediv as div, neg
+from operator import eq, lt, gt, le, ge, not_, and_, or_, truth
+
+from .cache import cache_path
+from .ink import (Assignment, Condition, Divert, Include, Knot, Op, Option,
+                  Stitch, Text, Texts, Var)
+
+
+class InkTransformer(Transformer):
+    const_none = lambda self, _: None
+    const_true = lambda self, _: True
+    const_false = lambda self, _: False
+
+    def var(self, s):
+        (s, ) = s
+        return Var(s.value)
+
+    def add(self, s):
+        item1, _op, item2 = s
+        return Op(add, item1, item2)
+
+    def sub(self, s):
+        item1, _op, item2 = s
+        return Op(sub, item1, item2)
+
+    def mul(self, s):
+        item1, _op, item2 = s
+        return Op(mul, item1, item2)
+
+    def div(self, s):
+        item1, _op, item2 = s
+        return Op(div, item1, item2)
+
+    def neg(self, s):
+        _op, item1 = s
+        return Op(neg, item1, None)
+
+    def variable(self, s):
+        assignment = s[1]
+        assignment.declaration = True
+        return assignment
+
+    def operation(self, s):
+        assignment = s[1]
+        assignment.declaration = False
+        return assignment
+
+    def assignment(self, s):
+        name, value = s
+        return Assignment(var=name.value.strip(), value=value)
+
+    def str(self, s):
+        (s, ) = s
+        return s.value[1:-1]
+
+    def number(self, s):
+        (s, ) = s
+        return float(s.value)
+
+    def include(self, s):
+        _include, filename, *rest = self.discard_newlines(s)
+        return Include(path=filename.value.strip())
+
+    def tag(self, s):
+        return s[0]
+
+    def text(self, s):
+        lines = []
+        texts = Texts(content=lines, divert=None)
+        glue_start = False
+        newlines = 0
+
+        for i in s:
+            match i:
+                case(Token(type="GLUESTART")):
+                    glue_start = True
+                case(Token(type="GLUEEND")):
+                    lines[-1].glue_end = True
+                case(Token(type="SH_COMMENT")):
+                    lines[-1].tag = i.value[1:].strip()
+                case(Divert()):
+                    i.inline = True
+                    texts.divert = i
+                case(Token(type="NEWLINE")):
+                    # paragraph
+                    if newlines == 2:
+                        lines.append(Text(text=""))
+                    else:
+                        newlines += 1
+                        continue
+                case(Token(type="STRING")):
+                    text = i.value.strip()
+                    if lines and lines[-1].glue_end:
+                        lines[-1].text += f" {text}"
+                        lines[-1].glue_end = False
+                        continue
+
+                    lines.append(Text(text=text, tag="", glue_start=glue_start))
+                    glue_start = False
+
+            newlines = 0
+        return texts
+
+    def eq(self, s):
+        op1, _eq, op2 = s
+        return Condition(operator=eq, item1=op1, item2=op2)
+
+    def lt(self, s):
+        op1, _op, op2 = s
+        return Condition(operator=lt, item1=op1, item2=op2)
+
+    def gt(self, s):
+        op1, _op, op2 = s
+        return Condition(operator=gt, item1=op1, item2=op2)
+
+    def gte(self, s):
+        op1, _op, op2 = s
+        return Condition(operator=ge, item1=op1, item2=op2)
+
+    def lte(self, s):
+        op1, _op, op2 = s
+        return Condition(operator=le, item1=op1, item2=op2)
+
+    def and_(self, s):
+        op1, _op, op2 = s
+        return Condition(operator=and_, item1=op1, item2=op2)
+
+    def or_(self, s):
+        op1, _op, op2 = s
+        return Condition(operator=or_, item1=op1, item2=op2)
+
+    def not_(self, s):
+        _op, op1 = s
+        return Condition(operator=not_, item1=op1, item2=None)
+
+    def logic(self, s):
+        _start, operation, _end = s
+        if not isinstance(operation, Condition):
+            return Condition(operator=truth, item1=operation, item2=None)
+        return operation
+
+    def opttext(self, s):
+        display_text = ""
+        pre = ""
+        suppress = ""
+        post = ""
+        tag = ""
+        divert = None
+        logic = None
+
+        for i in s:
+            if isinstance(i, Divert):
+                divert = i
+            elif isinstance(i, Condition):
+                logic = i
+            elif i.type == "OPTSTRING":
+                pre = i.value
+            elif i.type == "OPTSUPPRESS":
+                suppress = i.value
+            elif i.type == "OPTPOST":
+                post = i.value
+            elif i.type == "SH_COMMENT":
+                tag = i.value[1:].strip()
+
+        # Suppress text, option is the pre + suppress text and display_text is pre + post
+        option = f"{pre}{suppress}"
+        display_text = f"{pre}{post}"
+        fulltext = f"{option}{display_text}"
+
+        return (fulltext.strip(), option.strip(), display_text.strip(), tag, divert, logic)
+
+    def option(self, s):
+        _opt, opttext, *content = self.discard_newlines(s)
+        content = self.discard_newlines(content)
+        (fulltext, option, display_text, tag, divert, logic) = opttext
+        text = Text(text=fulltext, tag=tag)
+        # If there's a divert in the option, the followed content is ignored
+        if divert:
+            content = [divert]
+        return Option(content=content, text=text, display_text=display_text, option=option, logic=logic)
+
+    def options(self, s):
+        return s
+
+    def start(self, s):
+        return s
+
+    def knotheader(self, s):
+        knot, name = s
+        return name.value.strip()
+
+    def content(self, s):
+        return s
+
+    def knot(self, s):
+        header, content, *rest = self.discard_newlines(s)
+        content = self.discard_newlines(content)
+        rest = self.discard_newlines(rest)
+        stitches = {}
+        if isinstance(content, Stitch):
+            default_stitch = content
+            content = default_stitch.content
+            stitches[default_stitch.name] = default_stitch
+        if rest:
+            stitches.update({i.name: i for i in rest})
+        return Knot(content=content, name=header, stitches=stitches)
+
+    def stitchheader(self, s):
+        stitch, name = s
+        return name.value.strip()
+
+    def stitch(self, s):
+        header, content = self.discard_newlines(s)
+        content = self.discard_newlines(content)
+        return Stitch(name=header, content=content)
+
+    def divert(self, s):
+        ((knot, stitch), ) = s
+        return Divert(to=knot, stitch=stitch)
+
+    def divert_stitch(self, s):
+        _dot, stich_name = s
+        return stich_name.value.strip()
+
+    def divert_name(self, s):
+        knot, *stitch = s
+        stitch = stitch[0] if stitch else None
+        return (knot.value.strip(), stitch)
+
+    def is_newline(self, l):
+        return isinstance(l, Token) and l.type == "NEWLINE"
+
+    def discard_newlines(self, l):
+        if not isinstance(l, list):
+            return l
+        return [i for i in l if not self.is_newline(i)]
+
+
+_PARSER = None
+_PARSER_LOCK = threading.Lock()
+
+
+def _init_parser():
+    grammar = os.path.join(os.path.dirname(__file__), "ink.lark")
+    # Lark validates the cached tables against the grammar and lark version,
+    # so an outdated cache file is just rebuilt and overwritten
+    cache = cache_path("ink.lark.cache") or False
+    # The transformer is applied as the rules are reduced, so the parse tree
+    # is never built
+    return Lark.open(grammar, parser='lalr', cache=cache,
+                     transformer=InkTransformer())
+
+
+def get_parser():
+    """
+    Process-wide LALR parser, built the first time it's needed. It returns
+    the transformed statements instead of a parse tree.
+    """
+
+    global _PARSER
+
+    if _PARSER is None:
+        with _PARSER_LOCK:
+            if _PARSER is None:
+                _PARSER = _init_parser()
+    return _PARSER
+
+
+def parse(source):
+    """
+    Parse the ink source code and return the list of transformed statements
+    """
+
+    return get_parser().parse(source)
@@ -0,0 +1,172 @@
+import os
+import asyncio
+import itertools
+import subprocess
+
+from .scheduler import Poll, get_scheduler
+
+
+class ProcessSampler:
+    """
+    Shared sampler of the running processes command lines
+
+    All the waiters are served from the same snapshot, that is taken by the
+    scheduler only while there's at least one waiter, using the shortest
+    interval of the waiters. Only the new
+    processes are read in each sample, the command line of a known process
+    is only read again in the next sample after it appeared, to catch the
+    exec after a fork.
+    """
+
+    def __init__(self, interval=1):
+        self.interval = interval
+        # {pid: command line}
+        self._cmdlines = {}
+        # pids found in the last sample
+        self._recent = set()
+        # {handle: [text, future, checked, interval, max interval]}
+        self._waiters = {}
+        self._handles = itertools.count()
+        self._task = None
+        self._restart = False
+        self._proc = os.path.isdir("/proc")
+
+    @property
+    def running(self):
+        return self._task is not None
+
+    async def wait(self, text, interval=None, max_interval=None):
+        """
+        Wait until there's a process with the text in its command line
+        """
+
+        future = asyncio.get_running_loop().create_future()
+        handle = next(self._handles)
+        waiter = [text, future, False, interval, max_interval]
+        self._waiters[handle] = waiter
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        else:
+            # check the current snapshot without waiting for the next sample
+            self._check(waiter, self._cmdlines, verify=True)
+            # and poll again with the new interval
+            if interval and interval < self._interval():
+                self._restart = True
+
+        try:
+            await future
+        finally:
+            self._waiters.pop(handle, None)
+
+    async def _run(self):
+        scheduler = get_scheduler()
+        try:
+            self.sample()
+            while self._waiters:
+                self._restart = False
+                await scheduler.poll(self._poll, self._interval(),
+                                     self._max_interval())
+        finally:
+            self._task = None
+            self._cmdlines = {}
+            self._recent = set()
+
+    def _interval(self):
+        intervals = [w[3] for w in self._waiters.values() if w[3]]
+        return min(intervals, default=self.interval)
+
+    def _max_interval(self):
+        intervals = [w[4] for w in self._waiters.values() if w[4]]
+        return min(intervals, default=None)
+
+    def _poll(self):
+        if not self._waiters or self._restart:
+            return Poll.DONE
+        return Poll.ACTIVE if self.sample() else Poll.IDLE
+
+    def sample(self):
+        """
+        Take a new snapshot and resolve the matching waiters, returns True if
+        there are new processes
+        """
+
+        changed = self._update()
+        for waiter in self._waiters.values():
+            # new waiters are checked against all the processes, the rest
+            # only against the new ones
+            if waiter[2]:
+                self._check(waiter, changed)
+            else:
+                self._check(waiter, self._cmdlines, verify=True)
+        return bool(changed)
+
+    def _check(self, waiter, cmdlines, verify=False):
+        """
+        Resolve the waiter if the text is in any of the {pid: cmdline}. With
+        verify the matching command lines are read again, because a known
+        process could be finished or replaced since it was read
+        """
+
+        text, future = waiter[:2]
+        waiter[2] = True
+        if future.done():
+            return
+
+        for pid, cmdline in list(cmdlines.items()):
+            if text not in cmdline:
+                continue
+            if verify and self._proc and self._read_cmdline(pid) != cmdline:
+                continue
+            future.set_result(True)
+            return
+
+    def _update(self):
+        """
+        Update the command lines snapshot, returns the new {pid: cmdline}
+        """
+
+        if not self._proc:
+            return self._update_ps()
+
+        pids = {int(i) for i in os.listdir("/proc") if i.isdigit()}
+        for pid in self._cmdlines.keys() - pids:
+            del self._cmdlines[pid]
+
+        new = pids - self._cmdlines.keys()
+        changed = {}
+        for pid in new | (self._recent & pids):
+            cmdline = self._read_cmdline(pid)
+            if cmdline != self._cmdlines.get(pid):
+                self._cmdlines[pid] = cmdline
+                changed[pid] = cmdline
+        self._recent = new
+        return changed
+
+    def _read_cmdline(self, pid):
+        try:
+            with open(f"/proc/{pid}/cmdline", "rb") as f:
+                cmdline = f.read()
+        except OSError:
+            return ""
+        return cmdline.replace(b"\0", b" ").decode(errors="replace").strip()
+
+    def _update_ps(self):
+        output = subprocess.check_output(["ps", "-eo", "pid=,args="])
+        cmdlines = {}
+        for line in output.decode(errors="replace").splitlines():
+            pid, _, cmdline = line.strip().partition(" ")
+            cmdlines[int(pid)] = cmdline.strip()
+        changed = {k: v for k, v in cmdlines.items() if self._cmdlines.get(k) != v}
+        self._cmdlines = cmdlines
+        return changed
+
+
+_SAMPLER = None
+
+
+def process_sampler():
+    global _SAMPLER
+
+    if _SAMPLER is None:
+        _SAMPLER = ProcessSampler()
+    return _SAMPLER
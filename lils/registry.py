@@ -0,0 +1,202 @@
+import re
+import importlib
+
+from dataclasses import dataclass, field
+
+
+COMMANDRE = re.compile(r"^(?P<command>[^:]+):\s*(?P<args>([^\s]+\s*)+)$")
+LISTENRE = re.compile(r"^wait-?(?P<command>[^:]*):\s*(?P<args>([^\s]+\s*)+)$")
+# Tag options at the end of the args: "@500ms @max=30s"
+OPTIONSRE = re.compile(r"(\s+@\S+)+\s*$")
+DURATIONRE = re.compile(r"^(?P<value>\d+(\.\d+)?)(?P<unit>ms|s|m)?$")
+
+
+class Registry:
+    """
+    Command or listener handlers by name
+
+    The builtin handlers are the functions in the module with the prefix,
+    looked up each time so they can be replaced. Third party packages can
+    add handlers with entry points in the group, that are only imported
+    the first time a story uses them.
+    """
+
+    def __init__(self, group, module, prefix):
+        self.group = group
+        self._module = module
+        self._prefix = prefix
+        # {name: EntryPoint}
+        self._entry_points = None
+        # {name: handler}
+        self._loaded = {}
+
+    def __contains__(self, name):
+        return self._builtin(name) is not None or name in self._plugins()
+
+    def _builtin(self, name):
+        module = importlib.import_module(self._module)
+        return getattr(module, f"{self._prefix}{name}", None)
+
+    def _plugins(self):
+        if self._entry_points is None:
+            from importlib.metadata import entry_points
+
+            self._entry_points = {i.name: i for i in entry_points(group=self.group)}
+        return self._entry_points
+
+    def get(self, name):
+        handler = self._builtin(name)
+        if handler is not None:
+            return handler
+
+        if name not in self._loaded:
+            entry_point = self._plugins().get(name)
+            self._loaded[name] = entry_point.load() if entry_point else None
+        return self._loaded[name]
+
+    def register(self, name, handler):
+        """
+        Add a handler without an entry point
+        """
+
+        self._loaded[name] = handler
+        self._plugins()[name] = None
+
+    def unregister(self, name):
+        self._loaded.pop(name, None)
+        self._plugins().pop(name, None)
+
+
+COMMANDS = Registry("lils.commands", "lils.commands", "command_")
+LISTENERS = Registry("lils.listeners", "lils.listeners", "wait_")
+
+
+class UnknownTag(ValueError):
+    pass
+
+
+def parse_duration(text):
+    """
+    Duration in seconds, the value is in milliseconds if there's no unit
+    """
+
+    match = DURATIONRE.match(text)
+    if not match:
+        raise ValueError(f"Invalid duration '{text}'")
+
+    value = float(match.group("value"))
+    unit = match.group("unit") or "ms"
+    return value * {"ms": 0.001, "s": 1, "m": 60}[unit]
+
+
+def parse_options(args):
+    """
+    Split the tag args and the options at the end, returns the args and
+    a dict with the options {name: value}. The options are "@name=value" or
+    just "@value", that is stored with the name "".
+    """
+
+    match = OPTIONSRE.search(args)
+    if not match:
+        return args, {}
+
+    options = {}
+    for option in match.group(0).split():
+        name, _, value = option[1:].rpartition("=")
+        options[name] = value
+    return args[:match.start()], options
+
+
+def _option_text(name, value):
+    return f"{name}={value}" if name else value
+
+
+def command_options(options):
+    """
+    Command options: the timeout "@timeout=5s" and the variables to store
+    the exit status "@status=name" and the output "@output=name"
+    """
+
+    parsed = {}
+    for name, value in options.items():
+        match name:
+            case "timeout":
+                parsed["timeout"] = parse_duration(value)
+            case "status" | "output" if value:
+                parsed[name] = value
+            case _:
+                raise ValueError(f"Unknown command option '@{_option_text(name, value)}'")
+    return parsed
+
+
+def listener_options(options):
+    """
+    Listener options: the polling interval "@500ms" and the maximum
+    polling interval "@max=30s"
+    """
+
+    parsed = {}
+    for name, value in options.items():
+        match name:
+            case "":
+                parsed["interval"] = parse_duration(value)
+            case "max":
+                parsed["max_interval"] = parse_duration(value)
+            case _:
+                raise ValueError(f"Unknown listener option '@{_option_text(name, value)}'")
+    return parsed
+
+
+@dataclass
+class Command:
+    name: str
+    args: str
+    options: dict = field(default_factory=dict)
+
+
+@dataclass
+class Listener:
+    name: str
+    args: str
+    options: dict = field(default_factory=dict)
+
+    @property
+    def handler(self):
+        return LISTENERS.get(self.name)
+
+
+def compile_tag(tag):
+    """
+    Returns the (command, listener) for the tag, None if the tag is not a
+    command or a listener. UnknownTag is raised if the tag looks like a
+    command or listener but there's no handler for it.
+    """
+
+    if not tag:
+        return None, None
+
+    match = LISTENRE.match(tag)
+    if match:
+        name = match.group("command")
+        if name not in LISTENERS:
+            raise UnknownTag(f"Unknown listener 'wait-{name}'")
+        args, options = parse_options(match.group("args"))
+        try:
+            options = listener_options(options)
+        except ValueError as e:
+            raise UnknownTag(str(e)) from None
+        return None, Listener(name=name, args=args, options=options)
+
+    match = COMMANDRE.match(tag)
+    if match:
+        name = match.group("command")
+        if name not in COMMANDS:
+            raise UnknownTag(f"Unknown command '{name}'")
+        args, options = parse_options(match.group("args"))
+        try:
+            options = command_options(options)
+        except ValueError as e:
+            raise UnknownTag(str(e)) from None
+        return Command(name=name, args=args, options=options), None
+
+    return None, None
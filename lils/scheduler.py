@@ -0,0 +1,162 @@
+import enum
+import asyncio
+
+
+class Poll(enum.Enum):
+    """
+    Result of a polling check
+    """
+
+    # The check is completed and shouldn't run again
+    DONE = "done"
+    # Nothing changed since the last check
+    IDLE = "idle"
+    # Something changed, but the check is not completed
+    ACTIVE = "active"
+
+
+class _Entry:
+    __slots__ = ("check", "interval", "base", "max_interval", "backoff",
+                 "due", "future")
+
+
+class Scheduler:
+    """
+    Timer wheel for the polling checks
+
+    All the checks are run by a single timer, that is armed for the next tick
+    with checks due, so checks due in the same tick run together. Each check
+    runs every interval seconds, the interval grows with the backoff factor
+    each time the check is idle up to max_interval, and goes back to the
+    initial interval when there's some activity.
+    """
+
+    def __init__(self, loop, tick=0.05, slots=512, max_interval=5, backoff=1.5):
+        self.tick = tick
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self._loop = loop
+        self._wheel = [[] for _ in range(slots)]
+        self._start = loop.time()
+        # last processed tick
+        self._current = 0
+        self._count = 0
+        self._handle = None
+
+    def __len__(self):
+        return self._count
+
+    async def poll(self, check, interval=1, max_interval=None, backoff=None):
+        """
+        Run check every interval seconds until it returns Poll.DONE
+        """
+
+        entry = _Entry()
+        entry.check = check
+        entry.base = entry.interval = interval
+        entry.max_interval = max(interval, max_interval or self.max_interval)
+        entry.backoff = backoff or self.backoff
+        entry.future = self._loop.create_future()
+
+        self._count += 1
+        self._schedule(entry, self._now())
+        try:
+            await entry.future
+        finally:
+            self._count -= 1
+            if not entry.future.done():
+                entry.future.cancel()
+
+    def _now(self):
+        return int((self._loop.time() - self._start) / self.tick)
+
+    def _schedule(self, entry, now):
+        entry.due = now + max(1, round(entry.interval / self.tick))
+        self._wheel[entry.due % len(self._wheel)].append(entry)
+        self._arm(entry.due)
+
+    def _arm(self, due):
+        when = self._start + due * self.tick
+        if self._handle:
+            if self._handle.when() <= when:
+                return
+            self._handle.cancel()
+        self._handle = self._loop.call_at(when, self._on_tick)
+
+    def _on_tick(self):
+        self._handle = None
+        now = self._now()
+        size = len(self._wheel)
+        if now - self._current >= size:
+            ticks = range(now - size + 1, now + 1)
+        else:
+            ticks = range(self._current + 1, now + 1)
+        self._current = now
+
+        for tick in ticks:
+            slot = self._wheel[tick % size]
+            if not slot:
+                continue
+            due = [i for i in slot if i.due <= now]
+            slot[:] = [i for i in slot if i.due > now]
+            for entry in due:
+                self._run(entry, now)
+
+        next_due = self._next_due()
+        if next_due is not None:
+            self._arm(next_due)
+
+    def _run(self, entry, now):
+        if entry.future.done():
+            return
+
+        try:
+            result = entry.check()
+        except Exception as e:
+            entry.future.set_exception(e)
+            return
+
+        match result:
+            case Poll.DONE:
+                entry.future.set_result(None)
+                return
+            case Poll.ACTIVE:
+                entry.interval = entry.base
+            case _:
+                entry.interval = min(entry.interval * entry.backoff,
+                                     entry.max_interval)
+        self._schedule(entry, now)
+
+    def _next_due(self):
+        """
+        Returns the next tick with a check due, the first slots after the
+        current tick are the next ticks, but entries can be due in later
+        rounds of the wheel
+        """
+
+        size = len(self._wheel)
+        later = None
+        for offset in range(1, size + 1):
+            tick = self._current + offset
+            for entry in self._wheel[tick % size]:
+                if entry.future.done():
+                    continue
+                if entry.due <= tick:
+                    return tick
+                if later is None or entry.due < later:
+                    later = entry.due
+        return later
+
+
+_SCHEDULERS = {}
+
+
+def get_scheduler():
+    """
+    Returns the scheduler for the running loop
+    """
+
+    loop = asyncio.get_running_loop()
+    if loop not in _SCHEDULERS:
+        _SCHEDULERS[loop] = Scheduler(loop)
+    return _SCHEDULERS[loop]
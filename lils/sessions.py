@@ -0,0 +1,122 @@
+import time
+import uuid
+
+from collections import OrderedDict
+
+from .ink import InkScript
+from .listeners import cancel_listeners
+
+
+class UnknownSession(KeyError):
+    pass
+
+
+def _new_session(session_id, path):
+    return InkScript(path)
+
+
+class SessionTable:
+    """
+    Bounded table of running sessions by id
+
+    When the table is full the least recently used session is evicted, and
+    sessions not used for idle_timeout seconds are evicted by expire().
+    Evicted sessions are kept as a state snapshot and restored on demand.
+
+    The factory function creates a new session for the session id and the
+    story path.
+    """
+
+    def __init__(self, max_sessions=64, idle_timeout=30 * 60,
+                 max_suspended=1024, factory=_new_session):
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.max_suspended = max_suspended
+        self._factory = factory
+        # {id: (session, last use time)}, ordered by use
+        self._sessions = OrderedDict()
+        # {id: (story path, state)}, ordered by eviction
+        self._suspended = OrderedDict()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __contains__(self, session_id):
+        return session_id in self._sessions or session_id in self._suspended
+
+    def __iter__(self):
+        return iter(list(self._sessions))
+
+    def add(self, session):
+        session_id = uuid.uuid4().hex
+        self._insert(session_id, session)
+        return session_id
+
+    def create(self, path):
+        """
+        Create a new session for the story in the path, returns the session
+        id and the session
+        """
+
+        session_id = uuid.uuid4().hex
+        session = self._factory(session_id, path)
+        self._insert(session_id, session)
+        return session_id, session
+
+    def _insert(self, session_id, session):
+        self._sessions[session_id] = (session, time.monotonic())
+        while len(self._sessions) > self.max_sessions:
+            self.evict(next(iter(self._sessions)))
+
+    def get(self, session_id):
+        if session_id in self._suspended:
+            path, state = self._suspended[session_id]
+            session = self._factory(session_id, path)
+            # the snapshot is kept if it can't be restored, for example if
+            # the story changed since it was saved
+            session.load_state(state)
+            del self._suspended[session_id]
+            self._insert(session_id, session)
+            return session
+
+        try:
+            session, _last = self._sessions[session_id]
+        except KeyError:
+            raise UnknownSession(session_id) from None
+
+        self._sessions[session_id] = (session, time.monotonic())
+        self._sessions.move_to_end(session_id)
+        return session
+
+    def remove(self, session_id):
+        session, _last = self._sessions.pop(session_id, (None, None))
+        if session:
+            cancel_listeners(session)
+        self._suspended.pop(session_id, None)
+
+    def evict(self, session_id):
+        """
+        Remove the session from memory, keeping only the state snapshot
+        """
+
+        session, _last = self._sessions.pop(session_id)
+        cancel_listeners(session)
+        self._suspended[session_id] = (session.story.path, session.save_state())
+        while len(self._suspended) > self.max_suspended:
+            self._suspended.popitem(last=False)
+
+    def expire(self, now=None):
+        """
+        Evict the sessions not used in the last idle_timeout seconds
+        """
+
+        now = time.monotonic() if now is None else now
+        expired = []
+        # sessions are ordered by use, so the first ones are the oldest
+        for session_id, (_session, last) in self._sessions.items():
+            if now - last <= self.idle_timeout:
+                break
+            expired.append(session_id)
+        for session_id in expired:
+            self.evict(session_id)
+        return expired
@@ -0,0 +1,365 @@
+import os
+import re
+import errno
+import ctypes
+import ctypes.util
+import asyncio
+import itertools
+import struct
+
+from .scheduler import Poll, get_scheduler
+
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_IGNORED = 0x00008000
+IN_MASK_ADD = 0x20000000
+
+_EVENT = struct.Struct("iIII")
+
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        libc.inotify_init1
+    except (OSError, AttributeError):
+        return None
+
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    return libc
+
+
+class Inotify:
+    """
+    Minimal inotify binding, the events are read and dispatched to the
+    callbacks in the asyncio loop
+    """
+
+    def __init__(self, libc, loop):
+        self._libc = libc
+        self._loop = loop
+        self._fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+        # {wd: {handle: callback}}
+        self._callbacks = {}
+        self._handles = itertools.count()
+        loop.add_reader(self._fd, self._read)
+
+    def add_watch(self, path, mask, callback):
+        """
+        Call callback(mask, name) for each event in path, returns the watch
+        to remove with rm_watch
+        """
+
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path),
+                                          mask | IN_MASK_ADD)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+
+        handle = next(self._handles)
+        self._callbacks.setdefault(wd, {})[handle] = callback
+        return (wd, handle)
+
+    def rm_watch(self, watch):
+        wd, handle = watch
+        callbacks = self._callbacks.get(wd)
+        if callbacks is None:
+            return
+
+        callbacks.pop(handle, None)
+        if not callbacks:
+            del self._callbacks[wd]
+            self._libc.inotify_rm_watch(self._fd, wd)
+
+    def _read(self):
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            raise
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, _cookie, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+
+            callbacks = self._callbacks.get(wd, {})
+            if mask & IN_IGNORED:
+                # The watched file was removed, the kernel removes the watch
+                self._callbacks.pop(wd, None)
+            for callback in list(callbacks.values()):
+                callback(mask, name)
+
+
+_INOTIFY = {}
+
+
+def get_inotify():
+    """
+    Returns the Inotify object for the running loop or None if inotify is
+    not available
+    """
+
+    loop = asyncio.get_running_loop()
+    if loop not in _INOTIFY:
+        libc = _load_libc()
+        try:
+            _INOTIFY[loop] = Inotify(libc, loop) if libc else None
+        except OSError:
+            _INOTIFY[loop] = None
+    return _INOTIFY[loop]
+
+
+def _existing_ancestor(path):
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return path
+
+
+def _exists(path):
+    return lambda: Poll.DONE if os.path.exists(path) else Poll.IDLE
+
+
+async def wait_created(path, interval=0.2, max_interval=None):
+    """
+    Wait until the path exists, watching the nearest existing parent
+    directory, so it also works if the parent directories are created later.
+    Without inotify the path is polled every interval seconds.
+    """
+
+    path = os.path.abspath(path)
+    inotify = get_inotify()
+    changed = asyncio.Event()
+
+    if not inotify:
+        await get_scheduler().poll(_exists(path), interval, max_interval)
+        return
+
+    while True:
+        parent = _existing_ancestor(path)
+        if parent == path:
+            return
+
+        child = os.path.join(parent, os.path.relpath(path, parent).split(os.sep)[0])
+        name = os.path.basename(child)
+
+        def on_event(mask, event_name):
+            if event_name == name or mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                changed.set()
+
+        changed.clear()
+        try:
+            watch = inotify.add_watch(parent, IN_CREATE | IN_MOVED_TO |
+                                      IN_DELETE_SELF | IN_MOVE_SELF, on_event)
+        except OSError:
+            # Can't watch this directory, fallback to polling
+            await get_scheduler().poll(_exists(child), interval, max_interval)
+            continue
+
+        try:
+            # the child could be created before adding the watch
+            if not os.path.exists(child):
+                await changed.wait()
+        finally:
+            inotify.rm_watch(watch)
+
+
+class FileTail:
+    """
+    Reads the content appended to a file since the last read. If the file is
+    truncated or replaced, for example by log rotation, it starts reading
+    again from the beginning and the reset attribute is set to True
+    """
+
+    # Bytes kept from the start of the file to find a replaced file
+    HEAD = 64
+
+    def __init__(self, path):
+        self.path = path
+        self.reset = False
+        self._offset = 0
+        self._inode = None
+        # (mtime, ctime) in the last read
+        self._times = None
+        self._head = b""
+        self._replaced = False
+
+    def restart(self):
+        """
+        Read the file from the beginning in the next read, for a file known
+        to be replaced
+        """
+
+        self._replaced = True
+
+    def _start_over(self):
+        self.reset = self._inode is not None
+        self._offset = 0
+        self._head = b""
+
+    def read(self):
+        self.reset = False
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return b""
+
+        # a deleted and created again file can have the same inode
+        inode = (st.st_dev, st.st_ino)
+        times = (st.st_mtime_ns, st.st_ctime_ns)
+        if self._replaced or inode != self._inode or st.st_size < self._offset:
+            self._start_over()
+        elif times == self._times and st.st_size == self._offset:
+            return b""
+        self._replaced = False
+        self._inode = inode
+
+        try:
+            with open(self.path, "rb") as f:
+                # the file changed, check that it starts with the same content
+                if self._head and times != self._times:
+                    if f.read(len(self._head)) != self._head:
+                        self._start_over()
+                f.seek(self._offset)
+                data = f.read()
+        except OSError:
+            return b""
+
+        self._times = times
+        if not self._offset:
+            self._head = data[:self.HEAD]
+        self._offset += len(data)
+        return data
+
+
+class LiteralMatch:
+    """
+    Search for a literal text in a stream of chunks, keeping the end of the
+    previous chunk so matches between two chunks are found
+    """
+
+    def __init__(self, text):
+        self._needle = text.encode()
+        self._keep = len(self._needle) - 1
+        self._tail = b""
+
+    def reset(self):
+        self._tail = b""
+
+    def feed(self, data):
+        buf = self._tail + data
+        if self._needle in buf:
+            return True
+        self._tail = buf[len(buf) - self._keep:] if self._keep else b""
+        return False
+
+
+class RegexMatch:
+    """
+    Search for a regular expression in the complete lines of a stream of
+    chunks, the last incomplete line is kept until the next chunk completes
+    it, so a line without its line break is never matched
+    """
+
+    MAX_LINE = 64 * 1024
+
+    def __init__(self, pattern):
+        # ^ and $ match at each line, the buffer usually has many lines
+        flags = re.MULTILINE
+        if isinstance(pattern, re.Pattern):
+            flags |= pattern.flags & ~re.UNICODE
+            pattern = pattern.pattern
+        if isinstance(pattern, str):
+            pattern = pattern.encode()
+        self._re = re.compile(pattern, flags)
+        self._tail = b""
+
+    def reset(self):
+        self._tail = b""
+
+    def feed(self, data):
+        buf = self._tail + data
+        end = buf.rfind(b"\n") + 1
+        if end and self._re.search(buf, 0, end):
+            return True
+        self._tail = buf[end:][-self.MAX_LINE:]
+        return False
+
+
+async def wait_content(path, matcher, interval=1, max_interval=None):
+    """
+    Wait until the matcher finds its content in the file, only the appended
+    content is read each time the file is modified. Without inotify the file
+    is polled every interval seconds.
+    """
+
+    path = os.path.abspath(path)
+    parent, name = os.path.split(path)
+    tail = FileTail(path)
+
+    def check():
+        data = tail.read()
+        if tail.reset:
+            matcher.reset()
+        if not data:
+            return Poll.IDLE
+        return Poll.DONE if matcher.feed(data) else Poll.ACTIVE
+
+    inotify = get_inotify()
+    if not inotify:
+        if check() is not Poll.DONE:
+            await get_scheduler().poll(check, interval, max_interval)
+        return
+
+    changed = asyncio.Event()
+    watch = None
+
+    def on_event(mask, event_name):
+        if event_name == name and mask & (IN_CREATE | IN_MOVED_TO):
+            tail.restart()
+        if event_name == name or mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            changed.set()
+
+    try:
+        while True:
+            if not watch:
+                await wait_created(parent)
+                watch = inotify.add_watch(parent, IN_MODIFY | IN_CREATE |
+                                          IN_MOVED_TO | IN_CLOSE_WRITE |
+                                          IN_DELETE_SELF | IN_MOVE_SELF,
+                                          on_event)
+
+            changed.clear()
+            if check() is Poll.DONE:
+                return
+
+            await changed.wait()
+            if not os.path.isdir(parent):
+                # the parent directory was removed, watch it again
+                inotify.rm_watch(watch)
+                watch = None
+    except OSError:
+        # Can't watch the directory, fallback to polling
+        await get_scheduler().poll(check, interval, max_interval)
+    finally:
+        if watch:
+            inotify.rm_watch(watch)
@@ -10,28 +10,43 @@ const DEFAULT_IFACE = `
           <interface name='net.danigm.lils'>
             <method name='launch'>
               <arg type='s' name='filename' direction='in'/>
+              <arg type='s' name='session' direction='out'/>
               <arg type='as' name='output' direction='out'/>
             </method>
             <method name='choose'>
+              <arg type='s' name='session' direction='in'/>
               <arg type='u' name='option' direction='in'/>
               <arg type='as' name='output' direction='out'/>
             </method>
             <method name='output'>
+              <arg type='s' name='session' direction='in'/>
               <arg type='as' name='output' direction='out'/>
             </method>
             <method name='options'>
+              <arg type='s' name='session' direction='in'/>
               <arg type='as' name='output' direction='out'/>
             </method>
             <method name='var'>
+              <arg type='s' name='session' direction='in'/>
               <arg type='s' name='name' direction='in'/>
               <arg type='v' name='value' direction='out'/>
             </method>
+            <method name='set'>
+              <arg type='s' name='session' direction='in'/>
+              <arg type='a{sv}' name='values' direction='in'/>
+            </method>
             <method name='finished'>
+              <arg type='s' name='session' direction='in'/>
               <arg type='b' name='output' direction='out'/>
             </method>
+            <method name='close'>
+              <arg type='s' name='session' direction='in'/>
+            </method>
 
             <method name='reset'></method>
-            <signal name='changed'></signal>
+            <signal name='changed'>
+              <arg type='s' name='session'/>
+            </signal>
             <signal name='reset'></signal>
           </interface>
         </node>`
@@ -41,11 +56,13 @@ var LilsDbus = class LilsDbus {
         this._id = DEFAULT_ID;
         this._path = DEFAULT_PATH;
         this._iface = DEFAULT_IFACE;
+        this._session = null;
 
         const Proxy = Gio.DBusProxy.makeProxyWrapper(this._iface);
         this._proxy = new Proxy(Gio.DBus.session, this._id, this._path);
-        this._proxy.connectSignal('changed', () => {
-            onChange();
+        this._proxy.connectSignal('changed', (proxy, sender, [session]) => {
+            if (session === this._session)
+                onChange();
         });
     }
 
@@ -68,27 +85,31 @@ var LilsDbus = class LilsDbus {
     }
 
     launch(path) {
-        return this.grouped(this._proxy.launchSync(path)[0]);
+        if (this._session)
+            this._proxy.closeSync(this._session);
+        const [session, output] = this._proxy.launchSync(path);
+        this._session = session;
+        return this.grouped(output);
     }
 
     choose(index) {
-        return this.grouped(this._proxy.chooseSync(index)[0]);
+        return this.grouped(this._proxy.chooseSync(this._session, index)[0]);
     }
 
     output() {
-        return this.grouped(this._proxy.outputSync()[0]);
+        return this.grouped(this._proxy.outputSync(this._session)[0]);
     }
 
     options() {
-        return this._proxy.optionsSync()[0];
+        return this._proxy.optionsSync(this._session)[0];
     }
 
     getvar(name) {
-        return this._proxy.varSync(name)[0];
+        return this._proxy.varSync(this._session, name)[0];
     }
 
     finished() {
-        return this._proxy.finishedSync()[0];
+        return this._proxy.finishedSync(this._session)[0];
     }
 
     reset() {
@@ -0,0 +1,10 @@
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    """
+    Keep the parser and story caches out of the user cache directory
+    """
+
+    monkeypatch.setenv("LILS_CACHE_DIR", str(tmp_path / "cache"))
@@ -0,0 +1,35 @@
+import os
+import time
+from unittest.mock import patch
+
+from lils import cli
+
+
+def test_listener_while_reading(capsys):
+    def slow_input(prompt):
+        # the wait: 500 listener chooses opt1 before the answer
+        time.sleep(0.8)
+        return "2"
+
+    with patch("builtins.input", slow_input):
+        cli.run(os.path.join(os.path.dirname(__file__), "data", "wait-01.ink"))
+
+    output = capsys.readouterr().out.splitlines()
+    assert output[-2:] == ["- opt1", "OPT1"]
+
+
+def test_listener_before_reading(capsys):
+    answers = iter(["2", "1"])
+
+    def slow_input(prompt):
+        # the wait-test listener chooses opt1 just after the options
+        time.sleep(0.2)
+        return next(answers)
+
+    with patch("builtins.input", slow_input):
+        cli.run(os.path.join(os.path.dirname(__file__), "data", "wait-04.ink"))
+
+    output = capsys.readouterr().out.splitlines()
+    # the answer for the old options isn't used for the new ones
+    assert output == ["Start", "1. opt1", "2. opt2", "- opt1", "Next knot",
+                      "1. only", "- only"]
@@ -1,9 +1,16 @@
+import os
+import asyncio
 import time
 import pytest
 from unittest.mock import patch
 import subprocess
 
-from .utils import ink
+from lils.ink import InkScript, InkWarning, Story, Session
+from lils.commands import MAX_WORKERS, submit
+from lils.registry import COMMANDS, LISTENERS, Command, Listener
+from lils import listeners
+from lils.procs import ProcessSampler
+from .utils import ink, wait_until
 
 
 @patch("lils.commands.command_test")
@@ -12,19 +19,55 @@ def test_basic_command(url, test):
     script = ink(f"command-01")
     script.run()
 
-    script.output[0].run_command()
+    assert script.output[0].run_command() is None
+    assert script.output[1].run_command() is None
     assert test.call_count == 0
-    script.output[1].run_command()
-    assert test.call_count == 0
-    script.output[2].run_command()
+    assert script.output[2].run_command().result() == (0, "")
     assert test.call_count == 1
     assert test.call_args == (("arg1 arg2",), )
 
     script.choose(1)
-    assert url.call_count == 1
+    assert wait_until(lambda: url.call_count == 1)
     assert url.call_args == (("https://www.inklestudios.com/ink/web-tutorial/",), )
 
 
+def test_command_results():
+    COMMANDS.register("echo", lambda args: ["echo", args])
+    COMMANDS.register("sleep", lambda args: ["sleep", args])
+    try:
+        for option, expected in [
+            (0, {"status": 1, "output": "", "slow": -2}),
+            (1, {"status": 0, "output": "hello world", "slow": -2}),
+            (2, {"status": -2, "output": "", "slow": -1}),
+        ]:
+            script = InkScript(os.path.join(os.path.dirname(__file__), "data",
+                                            "command-02.ink"), use_cache=False)
+            script.run()
+            start = time.monotonic()
+            # choose doesn't wait for the command
+            script.choose(option)
+            assert time.monotonic() - start < 0.1
+            assert wait_until(lambda: all(script.var(k) == v
+                                          for k, v in expected.items()))
+    finally:
+        COMMANDS.unregister("echo")
+        COMMANDS.unregister("sleep")
+
+
+def test_long_command():
+    COMMANDS.register("sleep", lambda args: ["sleep", args])
+    try:
+        # more long running commands than workers
+        for _ in range(MAX_WORKERS + 1):
+            assert submit(Command("sleep", "2")).result(timeout=1) == (None, "")
+        start = time.monotonic()
+        status = submit(Command("sleep", "0", {"status": "done"})).result()
+        assert status == (0, "")
+        assert time.monotonic() - start < 1
+    finally:
+        COMMANDS.unregister("sleep")
+
+
 def test_wait_command():
     script = ink(f"wait-01")
     script.run()
@@ -48,6 +91,9 @@ def test_cancel():
 
 
 def test_wait_file():
+    if os.path.exists("/tmp/lils.ink"):
+        os.unlink("/tmp/lils.ink")
+
     script = ink(f"wait-02")
     script.run()
 
@@ -58,7 +104,7 @@ def test_wait_file():
         fp.write("This is a new line\n")
         fp.write("\n")
 
-    assert script.output[0] == "opt1"
+    assert wait_until(lambda: script.output[0] == "opt1", timeout=0.1)
 
     with open("/tmp/lils.ink", "a") as fp:
         fp.write("second line\n")
@@ -77,6 +123,7 @@ def test_wait_ps():
     p = subprocess.Popen(['yes', 'testwait'], stdout=subprocess.DEVNULL)
     time.sleep(2)
     p.kill()
+    p.wait()
 
     assert script.output[0] == "opt1"
 
@@ -85,3 +132,117 @@ def test_wait_ps():
     assert script.output[0] != "opt2"
     time.sleep(2)
     assert script.output[0] == "Wait for running process"
+
+
+def test_wait_newfile_parents(tmp_path):
+    target = tmp_path / "a" / "b" / "file"
+    story = tmp_path / "story.ink"
+    story.write_text(f"Waiting\n* created -> END # wait-newfile: {target}\n* other -> END\n")
+
+    script = InkScript(str(story), use_cache=False)
+    script.run()
+    assert script.output[0] == "Waiting"
+
+    # the listener follows the missing parent directories creation
+    (tmp_path / "a").mkdir()
+    time.sleep(0.05)
+    (tmp_path / "a" / "b").mkdir()
+    time.sleep(0.05)
+    assert script.output[0] == "Waiting"
+    target.write_text("")
+    assert wait_until(lambda: script.output[0] == "created", timeout=0.1)
+
+
+def test_wait_infile_regex(tmp_path):
+    target = tmp_path / "history"
+    story = tmp_path / "story.ink"
+    story.write_text(f"Waiting\n* found -> END # wait-infile: {target} /mkdir +-p/\n* other -> END\n")
+
+    # the file doesn't exist yet
+    script = InkScript(str(story), use_cache=False)
+    script.run()
+
+    target.write_text("ls\nmkdir foo\n")
+    time.sleep(0.05)
+    assert script.output[0] == "Waiting"
+    with open(target, "a") as f:
+        f.write("mkdir  -p foo/bar\n")
+    assert wait_until(lambda: script.output[0] == "found", timeout=0.1)
+
+
+def test_process_sampler():
+    sampler = ProcessSampler(interval=0.05)
+
+    async def wait():
+        waiters = [asyncio.create_task(sampler.wait("yes testsampler")) for i in range(5)]
+        await asyncio.sleep(0.1)
+        assert sampler.running
+        assert not any(i.done() for i in waiters)
+
+        p = subprocess.Popen(['yes', 'testsampler'], stdout=subprocess.DEVNULL)
+        try:
+            await asyncio.wait_for(asyncio.gather(*waiters), timeout=1)
+        finally:
+            p.kill()
+            p.wait()
+        await asyncio.sleep(0.1)
+        # the sampler only runs with active waiters
+        assert not sampler.running
+
+    asyncio.run(wait())
+
+
+def test_listeners_lifecycle():
+    script = ink(f"wait-03")
+    script.run()
+    script.set("x", 1)
+    script.set("x", 2)
+
+    # one listener per option, set doesn't start them again
+    tasks = list(listeners._LISTENERS[script].values())
+    assert len(tasks) == 2
+
+    script.run()
+    assert wait_until(lambda: all(t.cancelled() for t in tasks))
+    assert len(listeners._LISTENERS[script]) == 2
+
+    script.choose(1)
+    assert script not in listeners._LISTENERS
+
+    # other scripts listeners are not touched
+    other = ink("wait-03")
+    other.run()
+    script.run()
+    assert len(listeners._LISTENERS[other]) == 2
+
+
+def test_compiled_tags():
+    path = os.path.join(os.path.dirname(__file__), "data", "tags-01.ink")
+    with pytest.warns(InkWarning) as record:
+        Story(path, use_cache=False)
+    assert [str(i.message) for i in record] == [
+        "Unknown command 'unknown' in the script: unknown: arg",
+        "Unknown listener 'wait-plugin' in the script: wait-plugin: arg1",
+    ]
+
+    resolved = []
+
+    async def wait_plugin(script, index, question, args, **options):
+        resolved.append(args)
+        script.resolve(index, question)
+
+    LISTENERS.register("plugin", wait_plugin)
+    try:
+        with pytest.warns(InkWarning, match="Unknown command 'unknown'"):
+            story = Story(path, use_cache=False)
+
+        option = story.script[1][0]
+        assert option.listener == Listener(name="plugin", args="arg1")
+        assert story.script[0].content[0].command is None
+
+        script = Session(story)
+        script.run()
+        assert wait_until(lambda: script.output[-1] == "Plugin option")
+        assert resolved == ["arg1"]
+    finally:
+        LISTENERS.unregister("plugin")
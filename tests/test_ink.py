@@ -1,7 +1,17 @@
+import os
+import sys
+import asyncio
+import subprocess
+import threading
+import time
 import pytest
+from operator import add, eq, mul
+from unittest.mock import patch
 
-from lils.ink import Text
-from .utils import ink
+from lils.ink import InkScript, InkError, IncludeError, Text, get_parser, parse
+from lils.ink import Condition, Op, Option, Var
+from lils.ink import Knot, KnotSource, Session, Story
+from .utils import ink, wait_until
 
 
 @pytest.mark.parametrize("fixture,output",
@@ -325,3 +335,508 @@ def test_visit_logic():
     assert script.var("paris") == 2
     assert script.var("spain.madrid") == 1
     assert script.var("travel.london") == 1
+
+
+def test_import():
+    # the parser and the listeners loop are only imported when used
+    code = "import sys, lils.ink; print(sorted({'asyncio', 'lark'} & sys.modules.keys()))"
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.check_output([sys.executable, "-c", code], cwd=root)
+    assert output.decode().strip() == "[]"
+
+
+def test_shared_parser():
+    script1 = ink("basic-01")
+    script2 = ink("include-01")
+
+    assert get_parser() is get_parser()
+    assert not hasattr(script1, "_parser")
+    assert not hasattr(script2, "_tree")
+
+
+def test_compiled_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv("LILS_CACHE_DIR", str(tmp_path / "cache"))
+    included = tmp_path / "included.ink"
+    included.write_text("Included line\n")
+    main = tmp_path / "main.ink"
+    main.write_text(f"INCLUDE {included}\nMain line\n")
+
+    script = InkScript(str(main))
+    script.run()
+    assert script.output == ["Included line", "Main line"]
+    assert len(list((tmp_path / "cache" / "stories").iterdir())) == 1
+
+    with patch("lils.ink.parse") as parse:
+        script = InkScript(str(main))
+        script.run()
+        assert parse.call_count == 0
+    assert script.output == ["Included line", "Main line"]
+
+    # Changes in the included files invalidates the compiled story
+    included.write_text("Modified line\n")
+    script = InkScript(str(main))
+    script.run()
+    assert script.output == ["Modified line", "Main line"]
+
+
+def test_include_graph(tmp_path):
+    (tmp_path / "lib").mkdir()
+    (tmp_path / "lib" / "common.ink").write_text("Common line\n")
+    (tmp_path / "lib" / "module.ink").write_text("INCLUDE common.ink\nModule line\n")
+    main = tmp_path / "main.ink"
+    main.write_text("INCLUDE lib/common.ink\nINCLUDE lib/module.ink\nMain line\n")
+
+    with patch("lils.ink.parse", wraps=parse) as parse_mock:
+        script = InkScript(str(main), use_cache=False)
+        # main, common and module, common is only parsed once
+        assert parse_mock.call_count == 3
+
+    script.run()
+    assert script.output == ["Common line", "Common line", "Module line", "Main line"]
+
+
+def test_include_cycle(tmp_path):
+    (tmp_path / "a.ink").write_text("INCLUDE b.ink\nA\n")
+    (tmp_path / "b.ink").write_text("INCLUDE a.ink\nB\n")
+
+    with pytest.raises(IncludeError, match="a.ink -> .*b.ink -> .*a.ink"):
+        InkScript(str(tmp_path / "a.ink"), use_cache=False)
+
+
+def test_long_story(tmp_path):
+    knots = 2000
+    lines = ["-> knot0", ""]
+    for i in range(knots):
+        lines += [f"=== knot{i} ===", f"Line {i}", f"-> knot{i + 1}", ""]
+    lines += [f"=== knot{knots} ===", "The end", "-> END"]
+    story = tmp_path / "long.ink"
+    story.write_text("\n".join(lines) + "\n")
+
+    script = InkScript(str(story), use_cache=False)
+    script.run()
+    assert len(script.output) == knots + 1
+    assert script.output[-1] == "The end"
+    assert script.finished
+
+
+def test_compiled_expressions():
+    script = ink("logic-01")
+    script.run()
+
+    opt1, opt2, opt3, opt4, opt5 = script._allopts
+    assert opt1.logic._fn is not None
+    assert opt1.is_available({"opts": 0})
+    assert not opt1.is_available({"opts": 1})
+
+    # literal subexpressions are folded
+    expr = Op(add, 2.0, Op(mul, 3.0, 4.0))
+    assert expr.is_constant()
+    assert expr.evaluate(None) == 14.0
+    assert not Condition(eq, Var("x"), expr).is_constant()
+    assert Condition(eq, Var("x"), expr).evaluate({"x": 14.0})
+
+
+def test_unknown_divert(tmp_path):
+    story = tmp_path / "divert.ink"
+    story.write_text("-> travel\n\n=== travel ===\nAt the airport\n-> paris\n")
+
+    with pytest.raises(InkError, match="Unknown divert target 'paris' in knot 'travel'"):
+        InkScript(str(story), use_cache=False)
+
+
+def test_visit_counts():
+    script = ink("logic-02")
+    script.run()
+    script.choose(0)
+
+    assert script.var("travel") == 2
+    assert script.var("paris") == 1
+    assert script.vars["travel"] == 2
+    assert script.vars["spain.madrid"] == 0
+
+    script.set("paris", 0)
+    assert [i.display_text for i in script.options] == ["paris"]
+
+
+def test_shared_story():
+    script1 = ink("divert-01")
+    script2 = ink("divert-01")
+    assert script1.story is script2.story
+
+    # glue doesn't modify the shared story content
+    script1.run()
+    script1.choose(2)
+    assert script1.output == ["We hurried home to Savile Row as fast as we could."]
+    script1.run()
+    script1.choose(2)
+    assert script1.output == ["We hurried home to Savile Row as fast as we could."]
+
+    script2.run()
+    script2.choose(0)
+    assert script2.output == ["We hurried home to Savile Row", "as fast as we could."]
+    assert script1.var("glue") == 1
+    assert script2.var("glue") == 0
+
+
+def test_save_state():
+    script = ink("logic-02")
+    script.run()
+    script.choose(0)
+    script.choose(2)
+    state = script.save_state()
+
+    restored = ink("logic-02")
+    restored.load_state(state)
+    assert restored.output == script.output
+    assert [i.display_text for i in restored.options] == ["paris", "london", "madrid"]
+    assert restored.vars == script.vars
+
+    restored.choose(1)
+    assert restored.output[0] == "london"
+    assert restored.var("travel.london") == 1
+    assert restored.var("travel") == 4
+
+    with pytest.raises(InkError):
+        ink("logic-01").load_state(state)
+
+
+def test_lazy_knots(tmp_path):
+    path = os.path.join(os.path.dirname(__file__), "data", "stitch-02.ink")
+    eager = InkScript(path, use_cache=False)
+    eager.run()
+
+    with patch("lils.ink.parse", wraps=parse) as parse_mock:
+        story = Story(path, lazy=True)
+        # only the content before the first knot
+        assert parse_mock.call_count == 1
+        assert isinstance(story.knots["end"], KnotSource)
+        assert story.addresses == eager.story.addresses
+
+        script = Session(story)
+        script.run()
+        assert script.output == eager.output
+        assert parse_mock.call_count == 2
+        assert isinstance(story.knots["end"], KnotSource)
+
+        script.choose(2)
+        eager.choose(2)
+        assert script.output == eager.output
+        assert parse_mock.call_count == 3
+        assert isinstance(story.knots["end"], Knot)
+
+    # errors are only found in the loaded knots
+    broken = tmp_path / "broken.ink"
+    broken.write_text("-> start\n=== start ===\nStart\n-> END\n"
+                      "=== other ===\nOther\n-> unknown\n")
+    story = Story(str(broken), lazy=True)
+    script = Session(story)
+    script.run()
+    assert script.output == ["Start"]
+    with pytest.raises(InkError, match="Unknown divert target 'unknown'"):
+        story.validate()
+
+
+def test_load_lazy():
+    path = os.path.join(os.path.dirname(__file__), "data", "knot-01.ink")
+    eager = Story.load(path)
+    lazy = Story.load(path, lazy=True)
+    assert lazy is not eager
+    assert lazy.lazy and not eager.lazy
+    assert Story.load(path, lazy=True) is lazy
+    assert Story.load(path, jobs=2) is eager
+
+
+def test_parallel_includes(tmp_path):
+    (tmp_path / "lib").mkdir()
+    (tmp_path / "lib" / "common.ink").write_text("Common line\n")
+    (tmp_path / "lib" / "module.ink").write_text(
+        "INCLUDE common.ink\nModule line\n-> module\n"
+        "=== module ===\nModule knot\n-> END\n")
+    main = tmp_path / "main.ink"
+    main.write_text("INCLUDE lib/common.ink\nINCLUDE lib/module.ink\nMain line\n")
+
+    serial = Story(str(main), use_cache=False)
+    with patch("lils.ink.parse", wraps=parse) as parse_mock:
+        story = Story(str(main), use_cache=False, jobs=2)
+        # all the files are parsed in the worker processes
+        assert parse_mock.call_count == 0
+
+    assert repr(story.script) == repr(serial.script)
+    assert story.files == serial.files
+    script = Session(story)
+    script.run()
+    assert script.output == ["Common line", "Common line", "Module line",
+                             "Module knot"]
+
+
+def test_session_queue():
+    path = os.path.join(os.path.dirname(__file__), "data", "wait-01.ink")
+    dispatched = []
+    script = Session(Story.load(path), dispatch=dispatched.append)
+    script.run()
+    question = script._question
+
+    def resolve(question):
+        thread = threading.Thread(target=script.resolve, args=(0, question))
+        thread.start()
+        thread.join()
+
+    # resolutions from other threads run in the owner loop
+    resolve(question)
+    assert len(dispatched) == 1
+    assert script.output[0] != "opt1"
+    # old questions are dropped without going to the queue
+    resolve(question - 1)
+    assert len(dispatched) == 1
+
+    dispatched[0]()
+    assert script.output[0] == "opt1"
+
+
+def test_session_threads():
+    script = ink("wait-01")
+    script.run()
+
+    def change(n):
+        for i in range(200):
+            script.set(f"thread{n}", i)
+            script.resolve(1, script._question)
+
+    threads = [threading.Thread(target=change, args=(i, )) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for i in range(50):
+        script.run()
+    for thread in threads:
+        thread.join()
+
+    assert not script._queue
+    assert all(any(i is j for j in script._allopts) for i in script.options)
+
+
+def test_session_errors():
+    script = ink("wait-01")
+    script.run()
+    draining = threading.Event()
+    errors = []
+
+    def slow():
+        draining.set()
+        time.sleep(0.2)
+
+    def other():
+        try:
+            script._post(slow)
+        except Exception as e:
+            errors.append(e)
+
+    # the other thread drains the queue while the invalid option is chosen
+    thread = threading.Thread(target=other)
+    thread.start()
+    draining.wait()
+    with pytest.raises(InkError):
+        script.choose(5)
+    thread.join()
+    assert not errors
+    assert len(script.options) == 2
+
+
+def test_set_many():
+    changes = []
+    path = os.path.join(os.path.dirname(__file__), "data", "logic-01.ink")
+    script = InkScript(path, on_change=changes.append)
+    script.run()
+
+    with patch.object(script, "_update_options", wraps=script._update_options) as update:
+        script.set_many({"opts": 5, "other": 1})
+        assert update.call_count == 1
+    assert len(changes) == 1
+    assert [i.option for i in script.options] == ["opt3", "opt4", "opt5"]
+
+    with script.transaction():
+        script.set("opts", 1)
+        script.set("other", 2)
+        assert script.var("opts") == 1
+        assert len(changes) == 1
+    assert len(changes) == 2
+    assert [i.option for i in script.options] == ["opt2"]
+
+    with pytest.raises(ValueError):
+        with script.transaction():
+            script.set("opts", 3)
+            raise ValueError()
+    assert script.var("opts") == 1
+    assert len(changes) == 2
+
+
+def test_thread_transactions():
+    script = ink("logic-01")
+    script.run()
+    started = threading.Event()
+    other_done = threading.Event()
+
+    def other():
+        started.wait()
+        with script.transaction():
+            script.set("b", 2)
+            # the other thread batch isn't visible here
+            assert script.var("a") is None
+        other_done.set()
+
+    thread = threading.Thread(target=other)
+    thread.start()
+    with script.transaction():
+        script.set("a", 1)
+        started.set()
+        other_done.wait()
+        script.set("a2", 3)
+        assert script.var("b") == 2
+    thread.join()
+
+    assert [script.var(i) for i in ("a", "a2", "b")] == [1, 3, 2]
+
+
+def test_set_visit_counts():
+    changes = []
+    path = os.path.join(os.path.dirname(__file__), "data", "logic-02.ink")
+    script = InkScript(path, on_change=changes.append)
+    script.run()
+
+    script.set_many({"paris": 1.0})
+    assert script.var("paris") == 1
+    assert [i.option for i in script.options] == ["paris", "london", "madrid"]
+
+    for value in (1.5, -1, "3", None):
+        with pytest.raises(InkError):
+            script.set_many({"x": 5, "paris": value})
+    # nothing is changed if any value is invalid
+    assert script.var("x") is None
+    assert script.var("paris") == 1
+    assert len(changes) == 1
+
+
+def test_debounce():
+    changes = []
+    path = os.path.join(os.path.dirname(__file__), "data", "logic-01.ink")
+    script = InkScript(path, on_change=changes.append, debounce=0.05)
+    script.run()
+
+    for i in range(10):
+        script.set("opts", i % 6)
+    assert changes == []
+    assert wait_until(lambda: len(changes) == 1)
+    time.sleep(0.1)
+    assert len(changes) == 1
+    assert changes[0] == script.output
+    assert [i.option for i in script.options] == ["opt3", "opt4"]
+
+
+def test_option_dependencies():
+    script = ink("logic-01")
+    script.run()
+
+    opt1, opt2, opt3, opt4, opt5 = script._allopts
+    assert opt1.deps == {"opts"}
+    assert opt4.deps == {"opts"}
+    assert Condition(eq, Var("x"), Op(add, Var("y"), 1.0)).deps == {"x", "y"}
+
+    options = script.options
+    with patch("lils.ink.run_listeners") as run_listeners:
+        # not used in the options conditions
+        script.set("other", 1)
+        assert run_listeners.call_count == 0
+        with patch.object(Option, "is_available") as is_available:
+            script.set("other", 2)
+            assert is_available.call_count == 0
+        # the available options don't change
+        script.set("opts", 0)
+        assert script.options is options
+        assert run_listeners.call_count == 0
+
+    script.set("opts", 1)
+    assert [i.option for i in script.options] == ["opt2"]
+
+
+def test_stream():
+    for name in ["divert-01", "full-01", "stitch-02", "vars-01"]:
+        expected = ink(name)
+        expected.run()
+        script = ink(name)
+        *lines, options = script.stream()
+        assert lines == expected.output
+        assert options == expected.options
+
+        for i in range(3):
+            if not options:
+                break
+            expected.choose(len(options) - 1)
+            *lines, options = script.stream(len(options) - 1)
+            assert lines == expected.output
+            assert options == expected.options
+        assert script.finished == expected.finished
+
+
+def test_stream_snapshot():
+    expected = list(ink("logic-01").stream())
+    assert expected[0] == "Hello, world!"
+    script = ink("logic-01")
+    next_step = script._next_step
+
+    def next_step_and_restart():
+        finished = next_step()
+        if finished:
+            # a change queued from other thread runs just after the step
+            script._post(script._start_run)
+        return finished
+
+    with patch.object(script, "_next_step", next_step_and_restart):
+        assert repr(list(script.stream())) == repr(expected)
+
+
+def test_choose_invalid_option():
+    script = ink("divert-01")
+    script.run()
+    for option in (len(script.options), -1, None):
+        with pytest.raises(InkError):
+            script.choose(option)
+    script.choose(0)
+    assert script.output
+
+
+def test_stream_incremental():
+    script = ink("divert-01")
+    script.run()
+    stream = script.stream(0)
+    first = next(stream)
+    # the first line is yielded before the script stops
+    assert first == "We hurried home to Savile Row"
+    assert not script.finished
+
+    # other change stops the iteration
+    script.run()
+    assert all(isinstance(i, Text) for i in stream)
+
+
+def test_astream():
+    async def collect():
+        return [i async for i in script.astream()]
+
+    script = ink("divert-01")
+    *lines, options = asyncio.run(collect())
+    assert lines == script.output
+    assert options == script.options
+
+
+def test_slotted_nodes():
+    import pickle
+
+    option = Option(text=Text("Yes"), option="Yes", display_text="Yes",
+                    content=[Text("Ok")], logic=Condition(eq, Var("a"), 1))
+    assert not hasattr(option, "__dict__")
+    assert not hasattr(option.logic, "__dict__")
+    # the dependency sets are shared
+    assert option.logic.deps is Condition(eq, Var("a"), 2).deps
+
+    copy = pickle.loads(pickle.dumps(option))
+    assert repr(copy) == repr(option)
+    assert copy.logic.evaluate({"a": 1})
@@ -0,0 +1,58 @@
+import asyncio
+import pytest
+
+from lils.registry import parse_options, listener_options
+from lils.scheduler import Poll, Scheduler
+
+
+def test_scheduler_backoff():
+    async def poll():
+        loop = asyncio.get_running_loop()
+        scheduler = Scheduler(loop, tick=0.01, max_interval=0.08, backoff=2)
+        times = []
+        results = [Poll.IDLE] * 4 + [Poll.ACTIVE, Poll.IDLE, Poll.DONE]
+
+        def check():
+            times.append(loop.time())
+            return results[len(times) - 1]
+
+        start = loop.time()
+        await scheduler.poll(check, interval=0.01)
+        assert len(scheduler) == 0
+        return [round((t - start) * 100) for t in times]
+
+    times = asyncio.run(poll())
+    intervals = [b - a for a, b in zip([0] + times, times)]
+    # 1, 2, 4, 8 (max), 8, then back to 1 after activity
+    assert intervals == pytest.approx([1, 2, 4, 8, 8, 1, 2], abs=1)
+
+
+def test_scheduler_shared_ticks():
+    async def poll():
+        loop = asyncio.get_running_loop()
+        scheduler = Scheduler(loop, tick=0.05)
+        ticks = []
+
+        def check():
+            ticks.append(scheduler._current)
+            return Poll.DONE
+
+        await asyncio.gather(*[scheduler.poll(check, interval=i / 1000)
+                               for i in range(60, 90)])
+        return ticks
+
+    ticks = asyncio.run(poll())
+    # all the checks run in one or two ticks
+    assert len(ticks) == 30
+    assert len(set(ticks)) <= 2
+
+
+def test_listener_options():
+    assert parse_options("/tmp/file") == ("/tmp/file", {})
+    assert parse_options("/tmp/file @500ms") == ("/tmp/file", {"": "500ms"})
+
+    args, options = parse_options("/tmp/file some text @2s @max=1m")
+    assert args == "/tmp/file some text"
+    assert listener_options(options) == {"interval": 2, "max_interval": 60}
+    with pytest.raises(ValueError):
+        listener_options({"foo": "2s"})
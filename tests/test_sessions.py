@@ -0,0 +1,80 @@
+import pytest
+
+from lils.ink import InkError, InkScript
+from lils.sessions import SessionTable, UnknownSession
+from .utils import ink
+
+
+def test_session_table():
+    table = SessionTable(max_sessions=2)
+    script1 = ink("basic-01")
+    script2 = ink("basic-01")
+    script3 = ink("basic-01")
+    assert script1.story is script2.story
+
+    id1 = table.add(script1)
+    id2 = table.add(script2)
+    assert table.get(id1) is script1
+
+    # script2 is the least recently used
+    id3 = table.add(script3)
+    assert len(table) == 2
+    assert id2 not in table._sessions
+    assert table.get(id3) is script3
+
+    table.remove(id1)
+    assert id1 not in table
+    with pytest.raises(UnknownSession):
+        table.get(id1)
+
+
+def test_session_suspend():
+    table = SessionTable(max_sessions=1)
+    script = ink("logic-02")
+    script.run()
+    script.choose(0)
+
+    id1 = table.add(script)
+    id2 = table.add(ink("basic-01"))
+    assert len(table) == 1
+    assert id1 in table
+
+    # the evicted session is restored from its state
+    restored = table.get(id1)
+    assert restored is not script
+    assert id2 not in table._sessions
+    assert restored.output == script.output
+    assert restored.var("paris") == 1
+    restored.choose(1)
+    assert restored.output[0] == "london"
+
+
+def test_session_restore_error(tmp_path):
+    path = tmp_path / "story.ink"
+    path.write_text("Hello\n* Yes -> END\n")
+    table = SessionTable(max_sessions=1)
+    script = InkScript(str(path))
+    script.run()
+
+    id1 = table.add(script)
+    table.add(ink("basic-01"))
+    path.write_text("Bye\n* No -> END\n")
+
+    with pytest.raises(InkError):
+        table.get(id1)
+    # the snapshot is not lost
+    assert id1 in table
+    with pytest.raises(InkError):
+        table.get(id1)
+
+
+def test_session_expire():
+    table = SessionTable(idle_timeout=10)
+    id1 = table.add(ink("basic-01"))
+    id2 = table.add(ink("basic-01"))
+
+    now = table._sessions[id2][1]
+    assert table.expire(now + 5) == []
+    assert table.expire(now + 11) == [id1, id2]
+    assert len(table) == 0
+    assert id1 in table
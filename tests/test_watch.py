@@ -0,0 +1,92 @@
+import re
+import asyncio
+
+from lils.watch import FileTail, LiteralMatch, RegexMatch, wait_content
+
+
+def test_file_tail(tmp_path):
+    path = tmp_path / "file.log"
+    tail = FileTail(str(path))
+    assert tail.read() == b""
+
+    path.write_text("first\n")
+    assert tail.read() == b"first\n"
+    assert tail.read() == b""
+
+    with open(path, "a") as f:
+        f.write("second\n")
+    assert tail.read() == b"second\n"
+
+    # truncation
+    path.write_text("new\n")
+    assert tail.read() == b"new\n"
+    assert tail.reset
+
+    # rotation
+    path.rename(tmp_path / "file.log.1")
+    path.write_text("rotated content\n")
+    assert tail.read() == b"rotated content\n"
+    assert tail.reset
+
+
+def test_file_tail_recreated(tmp_path):
+    path = tmp_path / "file.log"
+    path.write_text("aaa\n")
+    tail = FileTail(str(path))
+    assert tail.read() == b"aaa\n"
+
+    # the new file can have the same inode
+    path.unlink()
+    path.write_text("needle\n")
+    assert tail.read() == b"needle\n"
+    assert tail.reset
+
+
+def test_wait_content_recreated(tmp_path):
+    path = tmp_path / "file.log"
+    path.write_text("aaa\n")
+
+    async def recreate():
+        task = asyncio.create_task(wait_content(str(path), LiteralMatch("needle"),
+                                                interval=0.05))
+        await asyncio.sleep(0.1)
+        path.unlink()
+        path.write_text("needle\n")
+        await asyncio.wait_for(task, 2)
+
+    asyncio.run(recreate())
+
+
+def test_literal_match():
+    matcher = LiteralMatch("second line")
+    assert not matcher.feed(b"first line\nsec")
+    assert not matcher.feed(b"ond ")
+    assert matcher.feed(b"line\n")
+
+    matcher = LiteralMatch("abc")
+    assert not matcher.feed(b"ab")
+    matcher.reset()
+    assert not matcher.feed(b"c")
+
+
+def test_regex_match():
+    matcher = RegexMatch(r"^export PATH=.*bin$")
+    assert not matcher.feed(b"ls -l\nexport PA")
+    assert not matcher.feed(b"TH=/usr/")
+    # the line is only matched once it's complete
+    assert not matcher.feed(b"bin")
+    assert matcher.feed(b"\n")
+
+    matcher = RegexMatch(r"^export PATH=.*bin$")
+    assert not matcher.feed(b"export PATH=/usr/bin")
+    assert not matcher.feed(b"ary\n")
+
+
+def test_regex_match_line():
+    # the matching line is in the middle of the chunk
+    matcher = RegexMatch(r"^export PATH=.*bin$")
+    assert matcher.feed(b"ls -l\nexport PATH=/usr/bin\nls\n")
+
+    matcher = RegexMatch(re.compile(rb"^ls$"))
+    assert not matcher.feed(b"ls -l\nexport PATH=/usr/bin\n")
+    assert matcher.feed(b"cd\nls\npwd\n")
@@ -1,4 +1,5 @@
 import os
+import time
 import pytest
 
 from lils.ink import InkScript
@@ -8,3 +9,17 @@ def ink(name):
     path = os.path.join(os.path.dirname(__file__), "data",
                         f"{name}.ink")
     return InkScript(path)
+
+
+def wait_until(condition, timeout=1):
+    """
+    Wait until the condition function returns True, listeners run in a
+    different thread so their results are not immediate
+    """
+
+    end = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > end:
+            return False
+        time.sleep(0.01)
+    return True